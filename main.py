@@ -1,3 +1,4 @@
+import asyncio
 import os
 from dotenv import load_dotenv
 load_dotenv()
@@ -5,6 +6,7 @@ load_dotenv()
 import logging
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from utils.firebase import init_firebase, get_db
 from datetime import datetime
 
@@ -16,8 +18,15 @@ from firebase_admin import credentials
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Serialize responses with orjson when it is installed
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+except ImportError:
+    DefaultResponse = JSONResponse
+
 # Initialize FastAPI app
-app = FastAPI(title="Artisan AI and Storytelling API")
+app = FastAPI(title="Artisan AI and Storytelling API", default_response_class=DefaultResponse)
 
 # Initialize Firebase
 init_firebase()
@@ -29,11 +38,22 @@ from routes.products import router as products_router
 from routes.ai_generate import router as ai_generate_router
 from routes.discover import router as discover_router
 from routes.story_router import router as story_router
+from routes.admin import router as admin_router
+from services.product_jobs import start_workers, stop_workers
+from services.embedding_index import drain_reindex_queue
+from services.discovery_feed import retry_failed_syncs
+from services.transcribe_audio import load_model
+from services.wishlist_coalescer import wishlist_coalescer
+from utils.profiling import profiling_middleware
+from fastapi.concurrency import run_in_threadpool
 
 # Load model and test Firebase connection at startup
 @app.on_event("startup")
 async def startup_event():
     try:
+        # Load Whisper once so the first request doesn't pay for it
+        await run_in_threadpool(load_model)
+
         # Test Firebase connections
         db = get_db()
         db.collection('test').document('ping').set({'status': 'ok'})
@@ -41,6 +61,40 @@ async def startup_event():
     except Exception as e:
         logger.error(f"Startup error (Model or Firebase): {e}")
         raise
+    # Background workers for async /products/generate jobs
+    await start_workers()
+    # Products re-written by offline jobs (e.g. the story backfill) while the server was down
+    asyncio.create_task(_drain_reindex_queue())
+    # Discovery feed syncs that failed after their product write committed
+    _background_tasks.append(asyncio.create_task(_retry_feed_syncs()))
+
+_background_tasks = []
+FEED_RETRY_INTERVAL_SECONDS = float(os.getenv("DISCOVERY_FEED_RETRY_SECONDS", "60"))
+
+async def _retry_feed_syncs():
+    while True:
+        await asyncio.sleep(FEED_RETRY_INTERVAL_SECONDS)
+        try:
+            repaired = await run_in_threadpool(retry_failed_syncs)
+            if repaired:
+                logger.info(f"Repaired {repaired} discovery feed syncs")
+        except Exception as e:
+            logger.error(f"Discovery feed retry error: {e}")
+
+async def _drain_reindex_queue():
+    try:
+        stats = await run_in_threadpool(drain_reindex_queue)
+        logger.info(f"Embedding reindex queue drained: {stats}")
+    except Exception as e:
+        logger.error(f"Embedding reindex queue error: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in _background_tasks:
+        task.cancel()
+    await stop_workers()
+    # Commit buffered wishlist taps before the process exits
+    await wishlist_coalescer.flush_all()
 
 # CORS Middleware for frontend communication
 origins = [
@@ -55,6 +109,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Opt-in sampling profiler (PROFILE_SAMPLE_RATE, or `X-Profile: 1` from an admin)
+app.middleware("http")(profiling_middleware)
 
 # Include routers
 app.include_router(auth_router, prefix="/auth")
@@ -63,6 +119,7 @@ app.include_router(products_router, prefix="/products")
 app.include_router(ai_generate_router, prefix="/ai")
 app.include_router(discover_router, prefix="/discover")
 app.include_router(story_router, prefix="/stories")
+app.include_router(admin_router, prefix="/admin")
 
 # Root endpoint (combined from both files)
 @app.get("/", tags=["Root"])
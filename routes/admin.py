@@ -0,0 +1,52 @@
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+from utils.dependencies import get_current_admin
+from utils.profiling import list_profiles, get_profile
+from services.story_services import llm
+from services.discovery_feed import rebuild_feed
+from services.embedding_index import drain_reindex_queue
+from fastapi.concurrency import run_in_threadpool
+import logging
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+@router.get("/profiles")
+async def get_recent_profiles(admin_uid: str = Depends(get_current_admin)):
+    """Summaries of the most recent profiled requests, newest first."""
+    return {"profiles": list_profiles()}
+
+@router.get("/profiles/{profile_id}")
+async def download_profile(
+    profile_id: str,
+    format: str = Query("speedscope", pattern="^(speedscope|collapsed)$"),
+    admin_uid: str = Depends(get_current_admin)
+):
+    profile = get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found or already evicted")
+    if format == "collapsed":
+        return PlainTextResponse(
+            profile.collapsed(),
+            headers={"Content-Disposition": f'attachment; filename="profile_{profile_id}.folded"'}
+        )
+    return JSONResponse(
+        profile.speedscope(),
+        headers={"Content-Disposition": f'attachment; filename="profile_{profile_id}.speedscope.json"'}
+    )
+
+@router.get("/llm-stats")
+async def get_llm_stats(admin_uid: str = Depends(get_current_admin)):
+    """Per-model latency percentiles, outcome counts and circuit state for this process."""
+    return {"models": llm.stats()}
+
+@router.post("/discovery/rebuild")
+async def rebuild_discovery_feed(admin_uid: str = Depends(get_current_admin)):
+    """Recomputes the discovery feed from `products` and story records (full scan)."""
+    feed = await run_in_threadpool(rebuild_feed)
+    return {"totalProducts": feed["totalProducts"], "categoryCounts": feed["categoryCounts"]}
+
+@router.post("/embeddings/reindex")
+async def reindex_embeddings(admin_uid: str = Depends(get_current_admin)):
+    """Re-embeds products queued by offline jobs such as the story backfill."""
+    return await run_in_threadpool(drain_reindex_queue)
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, File, UploadFile, Form, HTTPException
+from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Request, WebSocket, WebSocketDisconnect, status
 from typing import Annotated, Union
 from firebase_admin import firestore, storage
 import logging
@@ -8,6 +8,8 @@ from tempfile import NamedTemporaryFile
 from datetime import timedelta
 import uuid
 from services.transcribe_audio import transcribe_audio
+from services.streaming_transcriber import StreamingTranscriber, run_stream_session, acquire_stream_slot, release_stream_slot
+from utils.rate_limit import admit, audio_cost, charge, client_ip
 from fastapi.concurrency import run_in_threadpool
 
 router = APIRouter()
@@ -15,8 +17,45 @@ logger = logging.getLogger(__name__)
 db = firestore.client()
 bucket = storage.bucket()
 
+def _upload_audio(artisan_name: str, product_name: str, path: str, file_ext: str) -> str:
+    storage_path = f"audios/test_uploads/{artisan_name}/{product_name}_{uuid.uuid4()}{file_ext}"
+    blob = bucket.blob(storage_path)
+    blob.upload_from_filename(path)
+    return blob.generate_signed_url(expiration=timedelta(days=7))
+
+def _save_transcription(artisan_name: str, product_name: str, lang: Union[str, None], transcribed_text: str, audio_url: str) -> dict:
+    # Create product JSON object
+    product_entry = {
+        "name": product_name,
+        "bio": transcribed_text,
+        "audio_file": audio_url
+    }
+    
+    # Store in Firestore under artisans collection
+    artisan_ref = db.collection('artisans').document(artisan_name)
+    artisan_ref.set({
+        "name": artisan_name,
+        "products": firestore.ArrayUnion([product_entry])
+    }, merge=True)
+    
+    # Store transcription entry
+    db.collection('transcriptions').add({
+        'artisan_name': artisan_name,
+        'product_name': product_name,
+        'text': transcribed_text,
+        'audio_url': audio_url,
+        'lang': lang or 'auto',
+        'timestamp': firestore.SERVER_TIMESTAMP
+    })
+    
+    return {
+        "bio": transcribed_text,
+        "audio_file": audio_url
+    }
+
 @router.post("/transcribe-audio/")
 async def transcribe_audio_endpoint(
+    request: Request,
     artisan_name: Annotated[str, Form()],
     product_name: Annotated[str, Form()],
     lang: Annotated[Union[str, None], Form()] = None,
@@ -31,6 +70,9 @@ async def transcribe_audio_endpoint(
     if file.size > 100 * 1024 * 1024:
         raise HTTPException(status_code=400, detail="File too large (max 100MB).")
     
+    # Unauthenticated endpoint: only the client IP bucket applies
+    lease = await admit("transcription", request, cost=audio_cost(file.size))
+    
     temp_file = None
     try:
         _, file_ext = os.path.splitext(file.filename)
@@ -39,10 +81,7 @@ async def transcribe_audio_endpoint(
             temp_file_path = temp_file.name
         
         # Upload audio to Firebase Storage
-        storage_path = f"audios/test_uploads/{artisan_name}/{product_name}_{uuid.uuid4()}{file_ext}"
-        blob = bucket.blob(storage_path)
-        blob.upload_from_filename(temp_file_path)
-        audio_url = blob.generate_signed_url(expiration=timedelta(days=7))
+        audio_url = _upload_audio(artisan_name, product_name, temp_file_path, file_ext)
         
         # Run transcription in threadpool
         transcribed_text = await run_in_threadpool(
@@ -52,34 +91,7 @@ async def transcribe_audio_endpoint(
         if transcribed_text is None:
             raise HTTPException(status_code=500, detail="Transcription failed")
         
-        # Create product JSON object
-        product_entry = {
-            "name": product_name,
-            "bio": transcribed_text,
-            "audio_file": audio_url
-        }
-        
-        # Store in Firestore under artisans collection
-        artisan_ref = db.collection('artisans').document(artisan_name)
-        artisan_ref.set({
-            "name": artisan_name,
-            "products": firestore.ArrayUnion([product_entry])
-        }, merge=True)
-        
-        # Store transcription entry
-        db.collection('transcriptions').add({
-            'artisan_name': artisan_name,
-            'product_name': product_name,
-            'text': transcribed_text,
-            'audio_url': audio_url,
-            'lang': lang or 'auto',
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
-        
-        return {
-            "bio": transcribed_text,
-            "audio_file": audio_url
-        }
+        return _save_transcription(artisan_name, product_name, lang, transcribed_text, audio_url)
     
     except HTTPException:
         raise
@@ -87,5 +99,62 @@ async def transcribe_audio_endpoint(
         logger.error(f"Transcription endpoint error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     finally:
+        await lease.release()
         if temp_file and os.path.exists(temp_file.name):
-            os.unlink(temp_file.name)
\ No newline at end of file
+            os.unlink(temp_file.name)
+
+@router.websocket("/transcribe-audio/stream")
+async def stream_transcribe_audio(
+    websocket: WebSocket,
+    artisan_name: str,
+    product_name: str,
+    lang: Union[str, None] = None
+):
+    """Streams PCM16 16kHz mono audio frames in, pushes partial/final transcript segments out,
+    and on {"type": "stop"} stores the result exactly like POST /transcribe-audio/."""
+    # The session holds a transcription slot throughout and pays per minute of audio
+    client = f"ip:{client_ip(websocket)}"
+    if not acquire_stream_slot(client):
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Another streaming session is already open")
+        return
+    try:
+        lease = await admit("transcription", websocket)
+    except HTTPException as e:
+        release_stream_slot(client)
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=e.detail)
+        return
+
+    transcriber = StreamingTranscriber(lang, task="transcribe")
+    temp_file_path = None
+    try:
+        await websocket.accept()
+        if not await run_stream_session(websocket, transcriber, charge=lambda: charge("transcription", websocket, lease=lease)):
+            return
+        if not transcriber.text:
+            await websocket.send_json({"type": "error", "detail": "Transcription failed"})
+            await websocket.close()
+            return
+
+        with NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
+            temp_file_path = temp_file.name
+        await run_in_threadpool(transcriber.write_wav, temp_file_path)
+        audio_url = await run_in_threadpool(_upload_audio, artisan_name, product_name, temp_file_path, ".wav")
+        response = await run_in_threadpool(
+            _save_transcription, artisan_name, product_name, lang, transcriber.text, audio_url
+        )
+        await websocket.send_json({"type": "done", **response})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except ValueError as e:
+        await websocket.send_json({"type": "error", "detail": str(e)})
+        await websocket.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+    except Exception as e:
+        logger.error(f"Transcription stream error: {e}")
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        await lease.release()
+        release_stream_slot(client)
+        transcriber.close()
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
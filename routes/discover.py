@@ -2,6 +2,11 @@ from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from firebase_admin import firestore
 from utils.dependencies import get_current_buyer
+from services.discovery_feed import get_feed
+from services.image_derivatives import signed_list
+from services.wishlist_coalescer import wishlist_coalescer
+from fastapi.concurrency import run_in_threadpool
+from utils.projection import PRODUCT_FIELDS, parse_fields, select, project
 import logging
 
 router = APIRouter()
@@ -13,17 +18,47 @@ class GeoQuery(BaseModel):
     lon: float
     radius_km: float = 10.0
 
+def _signed_categories(recent_by_category: dict) -> dict:
+    return {name: signed_list(cards) for name, cards in recent_by_category.items()}
+
+@router.get("/feed")
+async def get_discovery_feed(category: str | None = None):
+    try:
+        # One cached document read instead of a scan of `products`
+        feed = await run_in_threadpool(get_feed)
+        if category:
+            cards = feed.get("recentByCategory", {}).get(category, [])
+            return {
+                "category": category,
+                "count": feed.get("categoryCounts", {}).get(category, 0),
+                "products": await run_in_threadpool(signed_list, cards)
+            }
+        return {
+            "totalProducts": feed.get("totalProducts", 0),
+            "categoryCounts": feed.get("categoryCounts", {}),
+            "regionCounts": feed.get("regionCounts", {}),
+            "recentByCategory": await run_in_threadpool(_signed_categories, feed.get("recentByCategory", {})),
+            "updatedAt": feed.get("updatedAt")
+        }
+    except Exception as e:
+        logger.error(f"Discovery feed error: {e}")
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+ARTISAN_FIELDS = ["name", "shopName", "location"]
+
 @router.get("/products-in-radius")
-async def get_products_in_radius(query: GeoQuery = Depends()):
+async def get_products_in_radius(query: GeoQuery = Depends(), fields: str | None = None):
+    selected = parse_fields(fields, PRODUCT_FIELDS)
     try:
         # Placeholder for GeoFirestore or geohashing implementation
-        # Query artisans within radius
-        artisans = db.collection('users').where('role', '==', 'artisan').get()  # Simplified
+        # Query artisans within radius; only the document ids are needed
+        artisans = db.collection('users').where('role', '==', 'artisan').select([]).get()  # Simplified
         artisan_ids = [artisan.id for artisan in artisans]
         
         # Query products for these artisans
-        products = db.collection('products').where('artisanId', 'in', artisan_ids).get()
-        product_list = [doc.to_dict() for doc in products]
+        products_query = db.collection('products').where('artisanId', 'in', artisan_ids)
+        products = select(products_query, selected).get()
+        product_list = await run_in_threadpool(signed_list, [project(doc.to_dict(), selected) for doc in products])
         
         return {"products": product_list}
     except Exception as e:
@@ -31,19 +66,19 @@ async def get_products_in_radius(query: GeoQuery = Depends()):
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @router.get("/artisans-in-radius")
-async def get_artisans_in_radius(query: GeoQuery = Depends()):
+async def get_artisans_in_radius(query: GeoQuery = Depends(), fields: str | None = None):
+    selected = parse_fields(fields, ARTISAN_FIELDS) or ARTISAN_FIELDS
     try:
         # Placeholder for GeoFirestore or geohashing implementation
-        artisans = db.collection('users').where('role', '==', 'artisan').get()  # Simplified
-        artisan_list = [
-            {
-                "userId": artisan.id,
-                "name": artisan.to_dict().get("name"),
-                "shopName": artisan.to_dict().get("shopName"),
-                "location": artisan.to_dict().get("location", {})
-            }
-            for artisan in artisans
-        ]
+        # Projection keeps wishlists, bios etc. out of the read
+        artisans = db.collection('users').where('role', '==', 'artisan').select(selected).get()  # Simplified
+        artisan_list = []
+        for artisan in artisans:
+            data = artisan.to_dict()
+            entry = {"userId": artisan.id}
+            for field in selected:
+                entry[field] = data.get(field, {} if field == "location" else None)
+            artisan_list.append(entry)
         return {"artisans": artisan_list}
     except Exception as e:
         logger.error(f"Artisans in radius error: {e}")
@@ -60,14 +95,8 @@ async def update_wishlist(
         if action not in ["add", "remove"]:
             raise HTTPException(status_code=400, detail="Invalid action. Must be 'add' or 'remove'")
         
-        if action == "add":
-            db.collection('users').document(uid).update({
-                'wishlist': firestore.ArrayUnion([productId])
-            })
-        else:
-            db.collection('users').document(uid).update({
-                'wishlist': firestore.ArrayRemove([productId])
-            })
+        # Buffered and netted with this user's other taps; one write per window
+        wishlist_coalescer.submit(uid, productId, action)
         
         return {"message": "Wishlist updated"}
     except Exception as e:
@@ -75,13 +104,17 @@ async def update_wishlist(
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @router.get("/me/wishlist")
-async def get_wishlist(current_buyer: tuple = Depends(get_current_buyer)):
+async def get_wishlist(fields: str | None = None, current_buyer: tuple = Depends(get_current_buyer)):
     user_data, uid = current_buyer
+    selected = parse_fields(fields, PRODUCT_FIELDS)
     try:
-        user_doc = db.collection('users').document(uid).get()
-        wishlist = user_doc.to_dict().get('wishlist', [])
-        products = db.collection('products').where('productId', 'in', wishlist).get()
-        product_list = [doc.to_dict() for doc in products]
+        user_doc = db.collection('users').document(uid).get(field_paths=['wishlist'])
+        wishlist = wishlist_coalescer.overlay(uid, user_doc.to_dict().get('wishlist', []))
+        if not wishlist:
+            return {"products": []}
+        products_query = db.collection('products').where('productId', 'in', wishlist)
+        products = select(products_query, selected).get()
+        product_list = await run_in_threadpool(signed_list, [project(doc.to_dict(), selected) for doc in products])
         return {"products": product_list}
     except Exception as e:
         logger.error(f"Get wishlist error: {e}")
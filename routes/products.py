@@ -1,15 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Request, Header
 from typing import Annotated
 from firebase_admin import firestore, storage
 from utils.dependencies import get_current_artisan
-from services.transcribe_audio import transcribe_audio
+from utils.rate_limit import admit, audio_cost
+from utils.idempotency import idempotency_store
+from utils.projection import PRODUCT_FIELDS, parse_fields, with_required, select, project
+from services.embedding_index import index_product, remove_product, similar_products
+from services.discovery_feed import sync_product
+from services.product_pipeline import create_product_from_media, PipelineError
+from services.product_jobs import submit_job, get_job, public_job_view, JobQueueFull
+from services.image_derivatives import signed_images, signed_list, srcset
+from services.artisan_summaries import record_product_change
 from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 import logging
 import os
 import shutil
 from tempfile import NamedTemporaryFile
-from datetime import timedelta
-import uuid
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -17,39 +24,104 @@ db = firestore.client()
 bucket = storage.bucket()
 
 @router.get("/my-products")
-async def get_my_products(current_artisan: tuple = Depends(get_current_artisan)):
+async def get_my_products(fields: str | None = None, current_artisan: tuple = Depends(get_current_artisan)):
     _, uid = current_artisan
+    selected = parse_fields(fields, PRODUCT_FIELDS)
     try:
-        products = db.collection('products').where('artisanId', '==', uid).get()
-        product_list = [doc.to_dict() for doc in products]
+        query = db.collection('products').where('artisanId', '==', uid)
+        products = select(query, selected).get()
+        product_list = await run_in_threadpool(signed_list, [project(doc.to_dict(), selected) for doc in products])
         return {"products": product_list}
     except Exception as e:
         logger.error(f"Get products error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-@router.get("/{productId}")
-async def get_product(productId: str):
+@router.get("/jobs/{jobId}")
+async def get_product_job(jobId: str, current_artisan: tuple = Depends(get_current_artisan)):
+    _, uid = current_artisan
     try:
-        product_doc = db.collection('products').document(productId).get()
-        if not product_doc.exists:
-            raise HTTPException(status_code=404, detail="Product not found")
-        product_data = product_doc.to_dict()
-        artisan_doc = db.collection('users').document(product_data['artisanId']).get()
-        if not artisan_doc.exists:
-            raise HTTPException(status_code=404, detail="Artisan not found")
-        artisan_data = artisan_doc.to_dict()
-        return {
-            "productId": productId,
+        job = await run_in_threadpool(get_job, jobId)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found")
+        if job.get("artisanId") != uid:
+            raise HTTPException(status_code=403, detail="Not authorized to view this job")
+        return await run_in_threadpool(public_job_view, job)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Get product job error: {e}")
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+@router.get("/{productId}/similar")
+async def get_similar_products(productId: str, limit: int = 10, include_details: bool = False):
+    if limit < 1 or limit > 50:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 50")
+    try:
+        matches = similar_products(productId, k=limit)
+        if matches is None:
+            raise HTTPException(status_code=404, detail="Product not indexed")
+        similar = [{"productId": pid, "score": round(score, 4)} for pid, score in matches]
+        if include_details and similar:
+            # One batched read instead of a document get per match
+            refs = [db.collection('products').document(item["productId"]) for item in similar]
+            docs = {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+            similar = await run_in_threadpool(signed_list, [
+                {
+                    **item,
+                    "title": docs[item["productId"]].get("title"),
+                    "tagline": docs[item["productId"]].get("tagline"),
+                    "imageUrl": docs[item["productId"]].get("imageUrl"),
+                    "imageVariants": docs[item["productId"]].get("imageVariants", {})
+                }
+                for item in similar if item["productId"] in docs
+            ])
+        return {"productId": productId, "similar": similar}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Similar products error: {e}")
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+def _signed_product(product_id: str, product_data: dict) -> dict:
+    return {
+        **signed_images({
+            "productId": product_id,
             "title": product_data.get("title"),
             "tagline": product_data.get("tagline"),
             "story": product_data.get("story"),
             "imageUrl": product_data.get("imageUrl"),
-            "artisan": {
+            "imageVariants": product_data.get("imageVariants", {})
+        }),
+        "srcset": srcset(product_data.get("imageVariants"))
+    }
+
+@router.get("/{productId}")
+async def get_product(productId: str, fields: str | None = None):
+    selected = parse_fields(fields, ["title", "tagline", "story", "imageUrl", "imageVariants", "srcset", "artisan"])
+    try:
+        # Only read the product fields the response needs (artisanId for the join);
+        # the native_* copies and audio metadata never leave Firestore
+        wanted = selected or ["title", "tagline", "story", "imageUrl", "imageVariants"]
+        wanted = ["imageVariants" if f == "srcset" else f for f in wanted if f != "artisan"]
+        product_fields = with_required(wanted, "artisanId")
+        product_doc = db.collection('products').document(productId).get(field_paths=product_fields)
+        if not product_doc.exists:
+            raise HTTPException(status_code=404, detail="Product not found")
+        product_data = product_doc.to_dict()
+        response = await run_in_threadpool(_signed_product, productId, product_data)
+        if selected is None or "artisan" in selected:
+            artisan_doc = db.collection('users').document(product_data['artisanId']).get(field_paths=["name", "shopName"])
+            if not artisan_doc.exists:
+                raise HTTPException(status_code=404, detail="Artisan not found")
+            artisan_data = artisan_doc.to_dict()
+            response["artisan"] = {
                 "userId": product_data['artisanId'],
                 "name": artisan_data.get("name"),
                 "shopName": artisan_data.get("shopName")
             }
-        }
+        if selected is not None:
+            response = {"productId": productId, **{f: response.get(f) for f in selected}}
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -87,7 +159,11 @@ async def update_product(
         if not update_data:
             raise HTTPException(status_code=400, detail="No fields provided for update")
         
-        db.collection('products').document(productId).update(update_data)
+        _, after = await run_in_threadpool(
+            record_product_change, uid, productId, ("update", update_data)
+        )
+        await run_in_threadpool(index_product, productId, after)
+        await run_in_threadpool(sync_product, productId, uid)
         return {"message": "Product updated successfully"}
     except HTTPException:
         raise
@@ -113,9 +189,15 @@ async def delete_product(productId: str, current_artisan: tuple = Depends(get_cu
         if product_data.get('audioUrl'):
             audio_blob = bucket.blob(product_data['audioUrl'].split(f"{bucket.name}/")[1])
             audio_blob.delete()
+        for variant_path in product_data.get('imageVariantPaths', []):
+            bucket.blob(variant_path).delete()
         
-        # Delete product document
-        db.collection('products').document(productId).delete()
+        # Delete product document (and fold it out of the artisan summary)
+        await run_in_threadpool(
+            record_product_change, uid, productId, ("delete", None)
+        )
+        await run_in_threadpool(remove_product, productId)
+        await run_in_threadpool(sync_product, productId, uid)
         return {"message": "Product deleted successfully"}
     except HTTPException:
         raise
@@ -125,10 +207,13 @@ async def delete_product(productId: str, current_artisan: tuple = Depends(get_cu
 
 @router.post("/generate")
 async def generate_product_description(
+    request: Request,
     lang: Annotated[str, Form()],
     image: UploadFile = File(...),
     audio: UploadFile = File(...),
     post_to_instagram: Annotated[bool, Form()] = False,
+    background: Annotated[bool, Form()] = False,
+    idempotency_key: str = Header(None, alias="Idempotency-Key"),
     current_artisan: tuple = Depends(get_current_artisan)
 ):
     user_data, uid = current_artisan
@@ -148,89 +233,75 @@ async def generate_product_description(
     if lang not in supported_langs:
         raise HTTPException(status_code=400, detail=f"Unsupported language code. Supported: {supported_langs}")
 
-    temp_audio_file = None
-    temp_image_file = None
+    # Retries with the same Idempotency-Key wait for, or replay, the original result
+    claim = await idempotency_store.begin(
+        f"products.generate:{uid}", idempotency_key,
+        fingerprint=f"{lang}:{background}:{audio.filename}:{audio.size}:{image.filename}:{image.size}"
+    )
+    if claim.replay:
+        if "jobId" in claim.response:
+            return JSONResponse(status_code=202, content=claim.response)
+        return claim.response
+
+    # Any exit without complete() releases the key so a retry can run (abandon is a no-op after complete)
     try:
+        # Two Whisper passes (transcribe + translate) over the uploaded audio
+        lease = await admit("transcription", request, uid=uid, cost=audio_cost(audio.size, passes=2))
+
         _, audio_ext = os.path.splitext(audio.filename)
         _, image_ext = os.path.splitext(image.filename)
+
+        if background:
+            # Tokens are charged, but concurrency is bounded by the job workers instead
+            await lease.release()
+            try:
+                job_id = await submit_job(
+                    uid, user_data, lang, audio.file, audio_ext, image.file, image_ext,
+                    post_to_instagram=post_to_instagram
+                )
+                response = {
+                    "message": "Product generation accepted",
+                    "jobId": job_id,
+                    "statusUrl": f"/products/jobs/{job_id}"
+                }
+                await claim.complete(response)
+                return JSONResponse(status_code=202, content=response)
+            except JobQueueFull:
+                raise HTTPException(status_code=503, detail="Too many pending jobs. Please retry later.", headers={"Retry-After": "30"})
+            except Exception as e:
+                logger.error(f"Submit product job error: {e}")
+                raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+        temp_audio_file = None
+        temp_image_file = None
+        try:
+            with NamedTemporaryFile(delete=False, suffix=audio_ext) as temp_audio_file, \
+                 NamedTemporaryFile(delete=False, suffix=image_ext) as temp_image_file:
+                shutil.copyfileobj(audio.file, temp_audio_file)
+                shutil.copyfileobj(image.file, temp_image_file)
+                temp_audio_path = temp_audio_file.name
+                temp_image_path = temp_image_file.name
         
-        with NamedTemporaryFile(delete=False, suffix=audio_ext) as temp_audio_file, \
-             NamedTemporaryFile(delete=False, suffix=image_ext) as temp_image_file:
-            shutil.copyfileobj(audio.file, temp_audio_file)
-            shutil.copyfileobj(image.file, temp_image_file)
-            temp_audio_path = temp_audio_file.name
-            temp_image_path = temp_image_file.name
-        
-        # Upload files to Firebase Storage
-        audio_storage_path = f"product-audio/{uid}/{uuid.uuid4()}{audio_ext}"
-        image_storage_path = f"product-images/{uid}/{uuid.uuid4()}{image_ext}"
-        
-        audio_blob = bucket.blob(audio_storage_path)
-        image_blob = bucket.blob(image_storage_path)
-        audio_blob.upload_from_filename(temp_audio_path)
-        image_blob.upload_from_filename(temp_image_path)
-        
-        audio_url = audio_blob.generate_signed_url(expiration=timedelta(days=7))
-        image_url = image_blob.generate_signed_url(expiration=timedelta(days=7))
-        
-        # Run transcription (native) and translation (English)
-        native_text = await run_in_threadpool(
-            transcribe_audio, temp_audio_path, lang, task="transcribe"
-        )
-        english_text = await run_in_threadpool(
-            transcribe_audio, temp_audio_path, lang, task="translate"
-        )
-        
-        if native_text is None or english_text is None:
-            raise HTTPException(status_code=500, detail="Audio processing failed")
-        
-        # Placeholder for Vision AI and Gemini integration
-        generated_content = {
-            "title": native_text[:50],
-            "tagline": english_text[:100],
-            "story": english_text,
-            "native_title": native_text[:50],
-            "native_tagline": native_text[:100],
-            "native_story": native_text,
-            "category": "Craft"
-        }
-        
-        # Save to Firestore products collection
-        product_id = f"prod_{uuid.uuid4().hex}"
-        product_entry = {
-            "productId": product_id,
-            "artisanId": uid,
-            "title": generated_content["title"],
-            "tagline": generated_content["tagline"],
-            "story": generated_content["story"],
-            "native_title": generated_content["native_title"],
-            "native_tagline": generated_content["native_tagline"],
-            "native_story": generated_content["native_story"],
-            "category": generated_content["category"],
-            "imageUrl": image_url,
-            "audioUrl": audio_url,
-            "lang": lang,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        }
-        db.collection('products').document(product_id).set(product_entry)
-        
-        # Placeholder for Instagram posting
-        if post_to_instagram:
-            logger.info("Instagram posting not implemented yet")
-        
-        return {
-            "message": "Product created successfully with AI!",
-            "productId": product_id,
-            "generatedContent": generated_content
-        }
+            response = await run_in_threadpool(
+                create_product_from_media, uid, user_data, lang, temp_audio_path, temp_image_path,
+                audio_ext, image_ext, post_to_instagram=post_to_instagram
+            )
+            response = await run_in_threadpool(signed_images, response)
+            await claim.complete(response)
+            return response
     
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Generate product error: {e}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+        except PipelineError as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Generate product error: {e}")
+            raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+        finally:
+            await lease.release()
+            if temp_audio_file and os.path.exists(temp_audio_file.name):
+                os.unlink(temp_audio_file.name)
+            if temp_image_file and os.path.exists(temp_image_file.name):
+                os.unlink(temp_image_file.name)
     finally:
-        if temp_audio_file and os.path.exists(temp_audio_file.name):
-            os.unlink(temp_audio_file.name)
-        if temp_image_file and os.path.exists(temp_image_file.name):
-            os.unlink(temp_image_file.name)
\ No newline at end of file
+        await claim.abandon()
\ No newline at end of file
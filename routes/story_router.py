@@ -1,70 +1,171 @@
 # routes/story_router.py
 
 import base64
+import hashlib
 import datetime
-from typing import List, Dict
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from typing import List, Dict, Optional
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Request, Header
 from fastapi.responses import JSONResponse
+from pydantic import BaseModel
 
-from services.story_services import generate_story_from_details, save_story_to_gcs_and_firestore
+from services.story_services import (
+    STORY_KEYS, generate_story_from_details, patch_story_fields, regenerate_story_fields,
+    save_story_to_gcs_and_firestore, story_ref
+)
+from services.llm_client import LLMUnavailableError
+from services.embedding_index import index_product
+from services.discovery_feed import sync_product
+from fastapi.concurrency import run_in_threadpool
 from firebase_admin import firestore
+from utils.dependencies import get_current_artisan
+from utils.rate_limit import admit, image_cost
+from utils.idempotency import idempotency_store
 
 # --- Router Setup ---
 router = APIRouter()
 db = firestore.client()
 
+class FieldRegenerationRequest(BaseModel):
+    user_id: str
+    product_id: str
+    fields: List[str]
+    instructions: Optional[str] = None
+
+async def ensure_product_owner(user_id: str, product_id: str):
+    """403 unless `product_id` is unused or an existing product of `user_id`.
+
+    A story overrides its product's discovery card and similarity vector, so it may only
+    be written under the product's own artisan.
+    """
+    product_doc = await run_in_threadpool(
+        db.collection('products').document(product_id).get, field_paths=["artisanId"]
+    )
+    if product_doc.exists and product_doc.to_dict().get("artisanId") != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized to write a story for this product")
+
 @router.post("/generate-story/", tags=["Story Generation"])
 async def generate_story_endpoint(
+    request: Request,
     user_id: str = Form(...),
     product_id: str = Form(...),
     audio_transcript: str = Form(...),
-    images: List[UploadFile] = File(...)
+    images: List[UploadFile] = File(...),
+    idempotency_key: str = Header(None, alias="Idempotency-Key"),
+    current_artisan: tuple = Depends(get_current_artisan)
 ):
+    _, uid = current_artisan
+    if user_id != uid:
+        raise HTTPException(status_code=403, detail="Not authorized to write stories for this artisan")
     if len(images) > 5:
         raise HTTPException(status_code=400, detail="Maximum 5 images allowed")
 
-    # 1. Fetch Artisan Details
-    artisan_ref = db.collection("artisans").document(user_id)
-    artisan_doc = artisan_ref.get()
-    if not artisan_doc.exists:
-        raise HTTPException(status_code=404, detail=f"Artisan with user_id '{user_id}' not found.")
+    # Retries with the same Idempotency-Key wait for, or replay, the original result
+    claim = await idempotency_store.begin(
+        f"stories.generate:{user_id}", idempotency_key,
+        fingerprint=f"{product_id}:{len(images)}:{hashlib.sha256(audio_transcript.encode()).hexdigest()}"
+    )
+    if claim.replay:
+        return JSONResponse(content=claim.response)
+
+    try:
+        await ensure_product_owner(user_id, product_id)
+
+        # 1. Fetch Artisan Details
+        artisan_ref = db.collection("artisans").document(user_id)
+        artisan_doc = artisan_ref.get()
+        if not artisan_doc.exists:
+            raise HTTPException(status_code=404, detail=f"Artisan with user_id '{user_id}' not found.")
     
-    artisan_data = artisan_doc.to_dict()
-    name = artisan_data.get("name")
-    shop_name = artisan_data.get("shop_name")
-    location = artisan_data.get("location")
-    if not all([name, shop_name, location]):
-        raise HTTPException(status_code=400, detail=f"Artisan document for '{user_id}' is missing required fields.")
-
-    # 2. Process Images
-    base64_images = []
-    for image_file in images:
-        image_bytes = await image_file.read()
-        base64_images.append(base64.b64encode(image_bytes).decode("utf-8"))
-
-    # 3. Call the Story Generation Service
-    details_dict = {
-        "audio_transcript": audio_transcript,
-        "name": name,
-        "shop_name": shop_name,
-        "location": location,
-        "base64_images": base64_images
-    }
-    story_content = generate_story_from_details(details_dict)
-    if "error" in story_content:
-        raise HTTPException(status_code=500, detail=f"Failed to generate story: {story_content['error']}")
-
-    # 4. Assemble and Save Final Data
-    final_data = {
-        "user_id": user_id,
-        "product_id": product_id,
-        "name": name,
-        "shop_name": shop_name,
-        "location": location,
-        "story": story_content,
-        "timestamp": datetime.datetime.utcnow().isoformat()
-    }
-    save_story_to_gcs_and_firestore(final_data)
-
-    # 5. Return Response
-    return JSONResponse(content=final_data)
\ No newline at end of file
+        artisan_data = artisan_doc.to_dict()
+        name = artisan_data.get("name")
+        shop_name = artisan_data.get("shop_name")
+        location = artisan_data.get("location")
+        if not all([name, shop_name, location]):
+            raise HTTPException(status_code=400, detail=f"Artisan document for '{user_id}' is missing required fields.")
+
+        # 2. Process Images
+        base64_images = []
+        for image_file in images:
+            image_bytes = await image_file.read()
+            base64_images.append(base64.b64encode(image_bytes).decode("utf-8"))
+
+        # 3. Call the Story Generation Service
+        details_dict = {
+            "audio_transcript": audio_transcript,
+            "name": name,
+            "shop_name": shop_name,
+            "location": location,
+            "base64_images": base64_images
+        }
+        lease = await admit("llm", request, uid=uid, cost=image_cost(len(base64_images)))
+        try:
+            story_content = await run_in_threadpool(generate_story_from_details, details_dict)
+        except LLMUnavailableError as e:
+            raise HTTPException(status_code=503, detail="Story generation is temporarily unavailable",
+                                headers={"Retry-After": str(int(e.retry_after))})
+        finally:
+            await lease.release()
+        if "error" in story_content:
+            raise HTTPException(status_code=500, detail=f"Failed to generate story: {story_content['error']}")
+
+        # 4. Assemble and Save Final Data
+        final_data = {
+            "user_id": user_id,
+            "product_id": product_id,
+            "name": name,
+            "shop_name": shop_name,
+            "location": location,
+            "story": story_content,
+            "timestamp": datetime.datetime.utcnow().isoformat()
+        }
+        save_story_to_gcs_and_firestore(final_data)
+        await run_in_threadpool(index_product, product_id, final_data)
+        await run_in_threadpool(sync_product, product_id, user_id)
+        await claim.complete(final_data)
+
+        # 5. Return Response
+        return JSONResponse(content=final_data)
+    finally:
+        await claim.abandon()
+
+@router.post("/regenerate-fields/", tags=["Story Generation"])
+async def regenerate_story_fields_endpoint(
+    request: Request,
+    body: FieldRegenerationRequest,
+    current_artisan: tuple = Depends(get_current_artisan)
+):
+    """Regenerates only the requested story keys (e.g. Tagline) from the existing story, text only."""
+    _, uid = current_artisan
+    if body.user_id != uid:
+        raise HTTPException(status_code=403, detail="Not authorized to edit this story")
+    fields = list(dict.fromkeys(body.fields))
+    unknown = [f for f in fields if f not in STORY_KEYS]
+    if not fields or unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {unknown}. Allowed: {STORY_KEYS}")
+
+    await ensure_product_owner(uid, body.product_id)
+    story_doc = await run_in_threadpool(story_ref(body.user_id, body.product_id).get)
+    if not story_doc.exists:
+        raise HTTPException(status_code=404, detail="Story not found; generate the full story first.")
+    previous = story_doc.to_dict()
+
+    # A short text-only prompt: one cost unit regardless of how many images the story had
+    lease = await admit("llm", request, uid=uid, cost=1)
+    try:
+        updates = await run_in_threadpool(
+            regenerate_story_fields, previous.get("story") or {}, fields, body.instructions
+        )
+    except LLMUnavailableError as e:
+        raise HTTPException(status_code=503, detail="Story generation is temporarily unavailable",
+                            headers={"Retry-After": str(int(e.retry_after))})
+    finally:
+        await lease.release()
+    if "error" in updates:
+        raise HTTPException(status_code=500, detail=f"Failed to regenerate fields: {updates['error']}")
+
+    timestamp = datetime.datetime.utcnow().isoformat()
+    await run_in_threadpool(patch_story_fields, body.user_id, body.product_id, updates, timestamp)
+    final_data = {**previous, "story": {**(previous.get("story") or {}), **updates}, "timestamp": timestamp}
+    await run_in_threadpool(index_product, body.product_id, final_data)
+    await run_in_threadpool(sync_product, body.product_id, body.user_id)
+    return JSONResponse(content={"product_id": body.product_id, "updated": updates, "story": final_data["story"]})
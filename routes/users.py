@@ -1,8 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form, Request, WebSocket, WebSocketDisconnect, status
 from typing import Annotated
 from firebase_admin import auth, firestore, storage
-from utils.dependencies import get_current_artisan
-from services.transcribe_audio import transcribe_audio
+from utils.dependencies import get_current_artisan, get_ws_artisan
+from utils.rate_limit import admit, audio_cost, charge
+from utils.projection import parse_fields
+from services.transcribe_audio import transcribe_audio, translation_is_identity
+from services.streaming_transcriber import StreamingTranscriber, run_stream_session, acquire_stream_slot, release_stream_slot
+from services.artisan_summaries import update_profile, get_summary, rebuild_summary
+from services.image_derivatives import signed_images, srcset
 from fastapi.concurrency import run_in_threadpool
 import logging
 import os
@@ -55,7 +60,7 @@ async def update_user_profile(
         raise HTTPException(status_code=400, detail="No fields provided for update")
     
     try:
-        db.collection('users').document(uid).update(update_data)
+        update_profile(uid, update_data)
         return {
             "message": "Profile updated successfully",
             "updatedFields": updated_fields
@@ -64,30 +69,68 @@ async def update_user_profile(
         logger.error(f"Profile update error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+PROFILE_FIELDS = ["name", "shopName", "address", "bio"]
+SUMMARY_FIELDS = ["location", "productCount", "categoryHistogram", "latestProducts"]
+
+def _signed_cards(cards: list) -> list:
+    return [
+        {**signed_images(card), "srcset": srcset({"thumbnail": card["thumbnail"]}) if card.get("thumbnail") else {}}
+        for card in cards
+    ]
+
 @router.get("/{artisanId}")
-async def get_artisan_profile(artisanId: str):
+async def get_artisan_profile(artisanId: str, fields: str | None = None):
+    selected = parse_fields(fields, PROFILE_FIELDS + SUMMARY_FIELDS) or PROFILE_FIELDS + SUMMARY_FIELDS
     try:
-        user_doc = db.collection('users').document(artisanId).get()
-        if not user_doc.exists:
-            raise HTTPException(status_code=404, detail="Artisan not found")
-        user_data = user_doc.to_dict()
-        if user_data.get('role') != 'artisan':
-            raise HTTPException(status_code=403, detail="User is not an artisan")
-        return {
+        # One read of the materialized summary; it only exists for artisans
+        summary = await run_in_threadpool(get_summary, artisanId, [*selected, "productCount"])
+        if summary is None or "productCount" not in summary:
+            user_doc = db.collection('users').document(artisanId).get(field_paths=[*PROFILE_FIELDS, "location", "role"])
+            if not user_doc.exists:
+                raise HTTPException(status_code=404, detail="Artisan not found")
+            user_data = user_doc.to_dict()
+            if user_data.get('role') != 'artisan':
+                raise HTTPException(status_code=403, detail="User is not an artisan")
+            summary = await run_in_threadpool(rebuild_summary, artisanId, user_data)
+        response = {
             "userId": artisanId,
-            "name": user_data.get("name"),
-            "shopName": user_data.get("shopName"),
-            "address": user_data.get("address"),
-            "bio": user_data.get("bio")
+            **{field: summary.get(field) for field in selected}
         }
+        if "latestProducts" in selected:
+            response["latestProducts"] = await run_in_threadpool(_signed_cards, summary.get("latestProducts", []))
+        return response
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Get artisan profile error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
+def _upload_bio_audio(uid: str, path: str, file_ext: str) -> str:
+    storage_path = f"product-audio/{uid}/bio_{uuid.uuid4()}{file_ext}"
+    blob = bucket.blob(storage_path)
+    blob.upload_from_filename(path)
+    return blob.generate_signed_url(expiration=timedelta(days=7))
+
+def _save_bio(uid: str, lang: str, english_text: str, native_text: str, audio_url: str) -> dict:
+    # Update artisan's bio in Firestore (mirrored into the artisan summary)
+    update_profile(uid, {
+        'bio': english_text,
+        'native_bio': native_text,
+        'bio_audio_url': audio_url,
+        'bio_lang': lang,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    
+    return {
+        "message": "Bio generated and updated successfully!",
+        "newBio": english_text,
+        "nativeBio": native_text,
+        "audioFile": audio_url
+    }
+
 @router.post("/me/generate-bio")
 async def generate_user_bio(
+    request: Request,
     lang: Annotated[str, Form()],
     audio: UploadFile = File(...),
     current_artisan: tuple = Depends(get_current_artisan)
@@ -105,6 +148,8 @@ async def generate_user_bio(
     if lang not in supported_langs:
         raise HTTPException(status_code=400, detail=f"Unsupported language code. Supported: {supported_langs}")
 
+    lease = await admit("transcription", request, uid=uid, cost=audio_cost(audio.size, passes=2))
+
     temp_file = None
     try:
         _, file_ext = os.path.splitext(audio.filename)
@@ -113,38 +158,23 @@ async def generate_user_bio(
             temp_file_path = temp_file.name
         
         # Upload audio to Firebase Storage
-        storage_path = f"product-audio/{uid}/bio_{uuid.uuid4()}{file_ext}"
-        blob = bucket.blob(storage_path)
-        blob.upload_from_filename(temp_file_path)
-        audio_url = blob.generate_signed_url(expiration=timedelta(days=7))
+        audio_url = _upload_bio_audio(uid, temp_file_path, file_ext)
         
         # Run transcription (native) and translation (English)
         native_text = await run_in_threadpool(
             transcribe_audio, temp_file_path, lang, task="transcribe"
         )
-        english_text = await run_in_threadpool(
-            transcribe_audio, temp_file_path, lang, task="translate"
-        )
+        if translation_is_identity(lang):
+            english_text = native_text
+        else:
+            english_text = await run_in_threadpool(
+                transcribe_audio, temp_file_path, lang, task="translate"
+            )
         
         if native_text is None or english_text is None:
             raise HTTPException(status_code=500, detail="Audio processing failed")
         
-        # Update artisan's bio in Firestore
-        artisan_ref = db.collection('users').document(uid)
-        artisan_ref.update({
-            'bio': english_text,
-            'native_bio': native_text,
-            'bio_audio_url': audio_url,
-            'bio_lang': lang,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
-        
-        return {
-            "message": "Bio generated and updated successfully!",
-            "newBio": english_text,
-            "nativeBio": native_text,
-            "audioFile": audio_url
-        }
+        return _save_bio(uid, lang, english_text, native_text, audio_url)
     
     except HTTPException:
         raise
@@ -152,5 +182,80 @@ async def generate_user_bio(
         logger.error(f"Bio generation error: {e}")
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     finally:
+        await lease.release()
         if temp_file and os.path.exists(temp_file.name):
-            os.unlink(temp_file.name)
\ No newline at end of file
+            os.unlink(temp_file.name)
+
+@router.websocket("/me/generate-bio/stream")
+async def stream_user_bio(
+    websocket: WebSocket,
+    lang: str,
+    current_artisan: tuple = Depends(get_ws_artisan)
+):
+    """Streams PCM16 16kHz mono audio frames in, pushes partial/final transcript segments out,
+    and on {"type": "stop"} saves the bio exactly like POST /me/generate-bio."""
+    if current_artisan is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    user_data, uid = current_artisan
+    supported_langs = ["ta-IN", "hi-IN", "en-IN"]
+    if lang not in supported_langs:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=f"Unsupported language code. Supported: {supported_langs}")
+        return
+    # The session holds a transcription slot throughout and pays per minute of audio
+    client = f"uid:{uid}"
+    if not acquire_stream_slot(client):
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="Another streaming session is already open")
+        return
+    try:
+        lease = await admit("transcription", websocket, uid=uid, cost=2)
+    except HTTPException as e:
+        release_stream_slot(client)
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason=e.detail)
+        return
+
+    transcriber = StreamingTranscriber(lang, task="transcribe")
+    temp_file_path = None
+    try:
+        await websocket.accept()
+        # Two passes per minute: the live transcription plus the translation after "stop"
+        if not await run_stream_session(
+            websocket, transcriber, charge=lambda: charge("transcription", websocket, uid=uid, cost=2, lease=lease)
+        ):
+            return
+        native_text = transcriber.text
+        if not native_text:
+            await websocket.send_json({"type": "error", "detail": "Audio processing failed"})
+            await websocket.close()
+            return
+
+        with NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
+            temp_file_path = temp_file.name
+        await run_in_threadpool(transcriber.write_wav, temp_file_path)
+        audio_url = await run_in_threadpool(_upload_bio_audio, uid, temp_file_path, ".wav")
+        # Only the English translation is left after "stop"
+        english_text = native_text if translation_is_identity(lang) else await run_in_threadpool(
+            transcribe_audio, temp_file_path, lang, task="translate"
+        )
+        if english_text is None:
+            await websocket.send_json({"type": "error", "detail": "Audio processing failed"})
+            await websocket.close()
+            return
+
+        response = await run_in_threadpool(_save_bio, uid, lang, english_text, native_text, audio_url)
+        await websocket.send_json({"type": "done", **response})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    except ValueError as e:
+        await websocket.send_json({"type": "error", "detail": str(e)})
+        await websocket.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+    except Exception as e:
+        logger.error(f"Bio stream error: {e}")
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+    finally:
+        await lease.release()
+        release_stream_slot(client)
+        transcriber.close()
+        if temp_file_path and os.path.exists(temp_file_path):
+            os.unlink(temp_file_path)
@@ -0,0 +1,32 @@
+# scripts/backfill_embeddings.py
+#
+# Embeds products created before the similarity index existed. Writers serialize on the
+# index file lock and running servers read the appended rows on their next lookup.
+# Run from the project root:
+#
+#   python -m scripts.backfill_embeddings --batch-size 256
+
+import argparse
+import logging
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from utils.firebase import init_firebase
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the product similarity index")
+    parser.add_argument("--batch-size", type=int, default=256, help="Products embedded per batch")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    init_firebase()
+    from services.embedding_index import backfill_index
+
+    stats = backfill_index(batch_size=args.batch_size)
+    logging.getLogger(__name__).info(f"Embedding backfill finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# scripts/backfill_image_derivatives.py
+#
+# Generates thumbnail/medium/large WebP + JPEG renditions for products created before
+# image derivatives existed, and rewrites variants stored as signed URLs to blob paths.
+# Each updated product's artisan summary and discovery card get the new thumbnail too.
+# Run from the project root:
+#
+#   python -m scripts.backfill_image_derivatives --limit 100 --concurrency 8
+
+import argparse
+import logging
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from utils.firebase import init_firebase
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill product image renditions")
+    parser.add_argument("--limit", type=int, default=None, help="Process at most this many products")
+    parser.add_argument("--concurrency", type=int, default=4, help="Products processed in parallel")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    init_firebase()
+    # Services create their Firestore/Storage clients at import time
+    from services.image_derivatives import backfill_all
+
+    stats = backfill_all(limit=args.limit, concurrency=args.concurrency)
+    logging.getLogger(__name__).info(f"Backfill finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# scripts/backfill_stories.py
+#
+# Regenerates product stories for the whole catalog after a prompt or category change.
+# Progress is checkpointed, so an interrupted run picks up where it stopped when run
+# again with the same --checkpoint. Regenerated products are queued for re-embedding;
+# the API server picks them up at startup or on POST /admin/embeddings/reindex.
+# Run from the project root:
+#
+#   python -m scripts.backfill_stories --dry-run
+#   python -m scripts.backfill_stories --sample 0.01 --checkpoint data/story_sample.json
+#   python -m scripts.backfill_stories --concurrency 16 --tpm 400000
+
+import argparse
+import logging
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from utils.firebase import init_firebase
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate product stories across the catalog")
+    parser.add_argument("--concurrency", type=int, default=8, help="LLM calls in flight at once")
+    parser.add_argument("--tpm", type=float, default=200_000, help="Estimated LLM tokens per minute budget")
+    parser.add_argument("--batch-size", type=int, default=100, help="Story documents per Firestore batch")
+    parser.add_argument("--sample", type=float, default=1.0, help="Fraction of products to process (by id hash)")
+    parser.add_argument("--limit", type=int, default=None, help="Process at most this many products")
+    parser.add_argument("--dry-run", action="store_true", help="Estimate work and tokens; no LLM calls or writes")
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint file (default STORY_BACKFILL_CHECKPOINT)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    init_firebase()
+    # Services create their Firestore/Storage clients at import time
+    from services.story_backfill import CHECKPOINT_PATH, StoryBackfill
+
+    stats = StoryBackfill(
+        concurrency=args.concurrency,
+        tokens_per_minute=args.tpm,
+        batch_size=args.batch_size,
+        sample_rate=args.sample,
+        limit=args.limit,
+        dry_run=args.dry_run,
+        checkpoint_path=args.checkpoint or CHECKPOINT_PATH
+    ).run()
+    logging.getLogger(__name__).info(f"Story backfill finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
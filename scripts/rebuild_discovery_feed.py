@@ -0,0 +1,30 @@
+# scripts/rebuild_discovery_feed.py
+#
+# Recomputes the discovery feed and its per-product cards from `products` and the
+# story records. Use it once to bring the existing catalog into the feed, or to repair
+# drift after failed incremental updates. It must also be run once after the feed moved
+# to shard documents and whenever DISCOVERY_FEED_SHARDS changes. Run from the project root:
+#
+#   python -m scripts.rebuild_discovery_feed
+
+import logging
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from utils.firebase import init_firebase
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    init_firebase()
+    from services.discovery_feed import rebuild_feed
+
+    feed = rebuild_feed()
+    logging.getLogger(__name__).info(
+        f"Discovery feed rebuilt: {feed['totalProducts']} products, {len(feed['categoryCounts'])} categories"
+    )
+
+
+if __name__ == "__main__":
+    main()
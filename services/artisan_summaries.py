@@ -0,0 +1,167 @@
+# services/artisan_summaries.py
+
+import datetime
+import logging
+import os
+from typing import Dict, Optional, Tuple
+
+from firebase_admin import firestore
+
+from services.discovery_feed import product_summary
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+
+# --- Configuration ---
+SUMMARY_COLLECTION = "artisan_summaries"
+SUMMARY_LATEST_N = int(os.getenv("ARTISAN_SUMMARY_LATEST_N", "12"))
+# Profile fields mirrored from `users` into the summary
+PROFILE_FIELDS = ["name", "shopName", "address", "bio", "location"]
+
+
+def _summary_ref(artisan_id: str):
+    return db.collection(SUMMARY_COLLECTION).document(artisan_id)
+
+
+def _new_summary(artisan_id: str, profile: Dict) -> Dict:
+    summary = {
+        "artisanId": artisan_id,
+        "productCount": 0,
+        "categoryHistogram": {},
+        "latestProducts": []
+    }
+    summary.update({f: profile.get(f) for f in PROFILE_FIELDS})
+    return summary
+
+
+def _fold(summary: Dict, before: Optional[Dict], after: Optional[Dict]):
+    """Applies one product transition (cards from product_summary) to a summary in place."""
+    histogram = summary.setdefault("categoryHistogram", {})
+    latest = [c for c in summary.get("latestProducts", [])
+              if c["productId"] not in {card["productId"] for card in (before, after) if card}]
+    if before:
+        summary["productCount"] = max(0, summary.get("productCount", 0) - 1)
+        count = histogram.get(before["category"], 0) - 1
+        if count > 0:
+            histogram[before["category"]] = count
+        else:
+            histogram.pop(before["category"], None)
+    if after:
+        summary["productCount"] = summary.get("productCount", 0) + 1
+        histogram[after["category"]] = histogram.get(after["category"], 0) + 1
+        latest.append(after)
+    latest.sort(key=lambda c: str(c.get("createdAt", "")), reverse=True)
+    summary["latestProducts"] = latest[:SUMMARY_LATEST_N]
+    summary["updatedAt"] = datetime.datetime.utcnow().isoformat()
+
+
+def _build_summary(artisan_id: str, profile: Dict, transaction=None, skip_id: Optional[str] = None) -> Dict:
+    """Folds all of the artisan's products (except `skip_id`) into a fresh summary."""
+    summary = _new_summary(artisan_id, profile)
+    query = db.collection("products").where("artisanId", "==", artisan_id)
+    for doc in query.stream(transaction=transaction):
+        if doc.id != skip_id:
+            _fold(summary, None, product_summary(doc.id, doc.to_dict()))
+    return summary
+
+
+@firestore.transactional
+def _product_transaction(transaction, artisan_id: str, product_id: str,
+                         product_write: Tuple[str, Optional[Dict]]) -> Tuple[Optional[Dict], Optional[Dict]]:
+    summary_ref = _summary_ref(artisan_id)
+    product_ref = db.collection("products").document(product_id)
+    # `before` comes from this transaction's read, so concurrent writes to the same product
+    # serialize instead of folding a stale state twice
+    product_snapshot = product_ref.get(transaction=transaction)
+    before = product_snapshot.to_dict() if product_snapshot.exists else None
+    op, data = product_write
+    if op == "set":
+        after = data
+    elif op == "update":
+        after = {**before, **data} if before else None
+    else:
+        after = None
+    snapshot = summary_ref.get(transaction=transaction)
+    summary = snapshot.to_dict() if snapshot.exists else None
+    if summary is None or "productCount" not in summary:
+        # No complete summary yet: start from the artisan's other products so existing
+        # catalogs are counted, then apply this product's new state exactly once
+        user_doc = db.collection("users").document(artisan_id).get(transaction=transaction)
+        profile = user_doc.to_dict() if user_doc.exists else {}
+        summary = _build_summary(artisan_id, profile, transaction=transaction, skip_id=product_id)
+        folded_before = None
+    else:
+        folded_before = before
+
+    _fold(
+        summary,
+        product_summary(product_id, folded_before) if folded_before else None,
+        product_summary(product_id, after) if after else None
+    )
+
+    # The product write commits atomically with the summary it affects
+    if op == "set":
+        transaction.set(product_ref, data)
+    elif op == "update":
+        # Raises NotFound if the product was deleted meanwhile
+        transaction.update(product_ref, data)
+    elif op == "delete":
+        transaction.delete(product_ref)
+    transaction.set(summary_ref, summary)
+    return before, after
+
+
+def record_product_change(artisan_id: str, product_id: str,
+                          product_write: Tuple[str, Optional[Dict]]) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """Writes a product create/update/delete and folds it into the artisan's summary in one transaction.
+
+    `product_write` is ("set", data), ("update", fields) or ("delete", None); the previous
+    state is read inside the transaction. Returns the product (before, after) the change
+    was applied to. Unlike the discovery feed, errors propagate: the product write itself
+    is part of the transaction.
+    """
+    return _product_transaction(db.transaction(), artisan_id, product_id, product_write)
+
+
+@firestore.transactional
+def _profile_transaction(transaction, uid: str, update_data: Dict):
+    summary_ref = _summary_ref(uid)
+    mirrored = {f: update_data[f] for f in PROFILE_FIELDS if f in update_data}
+    # Only complete summaries are patched; a missing one is built in full on first use
+    has_summary = bool(mirrored) and summary_ref.get(transaction=transaction).exists
+    transaction.update(db.collection("users").document(uid), update_data)
+    if has_summary:
+        mirrored["updatedAt"] = datetime.datetime.utcnow().isoformat()
+        transaction.update(summary_ref, mirrored)
+
+
+def update_profile(uid: str, update_data: Dict):
+    """Updates a `users` document and mirrors the summary-relevant fields in one transaction."""
+    _profile_transaction(db.transaction(), uid, update_data)
+
+
+def get_summary(artisan_id: str, field_paths=None) -> Optional[Dict]:
+    snapshot = _summary_ref(artisan_id).get(field_paths=field_paths)
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+@firestore.transactional
+def _rebuild_transaction(transaction, artisan_id: str, profile: Dict) -> Dict:
+    summary_ref = _summary_ref(artisan_id)
+    snapshot = summary_ref.get(transaction=transaction)
+    existing = snapshot.to_dict() if snapshot.exists else None
+    if existing is not None and "productCount" in existing:
+        # Built by a concurrent product change or reader since the caller looked
+        return existing
+    summary = _build_summary(artisan_id, profile, transaction=transaction)
+    transaction.set(summary_ref, summary)
+    return summary
+
+
+def rebuild_summary(artisan_id: str, profile: Dict) -> Dict:
+    """Builds a summary from the artisan's products when none exists yet.
+
+    Runs in a transaction over the summary and the product query, so a product change
+    committing meanwhile forces a retry instead of being overwritten.
+    """
+    return _rebuild_transaction(db.transaction(), artisan_id, profile)
@@ -0,0 +1,296 @@
+# services/discovery_feed.py
+
+import datetime
+import logging
+import os
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+
+# --- Configuration ---
+FEED_COLLECTION = "discovery"
+FEED_DOCUMENT = "feed"
+# Each product's counts and card live in one of N shard documents (feed_0..feed_{N-1}) so
+# concurrent syncs don't all contend on one document; changing N requires rebuild_feed()
+FEED_SHARDS = int(os.getenv("DISCOVERY_FEED_SHARDS", "16"))
+# Products whose feed sync failed, retried by retry_failed_syncs()
+PENDING_COLLECTION = "discovery_pending"
+# One document per product holding the card currently folded into the feed
+CARDS_COLLECTION = "discovery_cards"
+FEED_TOP_N = int(os.getenv("DISCOVERY_FEED_TOP_N", "20"))
+FEED_CACHE_TTL_SECONDS = float(os.getenv("DISCOVERY_FEED_CACHE_TTL", "30"))
+
+_cache_lock = threading.Lock()
+_cached_feed: Optional[Dict] = None
+_cached_at = 0.0
+
+
+def _shard_ref(shard: int):
+    return db.collection(FEED_COLLECTION).document(f"{FEED_DOCUMENT}_{shard}")
+
+
+def _shard_of(product_id: str) -> int:
+    return zlib.crc32(product_id.encode("utf-8")) % FEED_SHARDS
+
+
+def _empty_feed() -> Dict:
+    return {"categoryCounts": {}, "regionCounts": {}, "recentByCategory": {}, "totalProducts": 0}
+
+
+def region_of(location) -> Optional[str]:
+    """Normalizes an artisan location (string or map) to a region label."""
+    if isinstance(location, dict):
+        location = location.get("region") or location.get("state") or location.get("city")
+    if not location:
+        return None
+    return str(location).split(",")[-1].strip() or None
+
+
+def product_summary(product_id: str, data: Dict) -> Dict:
+    """Compact card for a product document or a generated story record."""
+    story = data.get("story")
+    if isinstance(story, dict):
+        title, tagline, category = story.get("Title"), story.get("Tagline"), story.get("Category")
+    else:
+        title, tagline, category = data.get("title"), data.get("tagline"), data.get("category")
+    created_at = data.get("createdAt") or data.get("timestamp")
+    if hasattr(created_at, "isoformat"):
+        created_at = created_at.isoformat()
+    if not isinstance(created_at, str):  # e.g. an unresolved SERVER_TIMESTAMP sentinel
+        created_at = datetime.datetime.utcnow().isoformat()
+    return {
+        "productId": product_id,
+        "artisanId": data.get("artisanId") or data.get("user_id"),
+        "title": title,
+        "tagline": tagline,
+        "imageUrl": data.get("imageUrl"),
+        "thumbnail": (data.get("imageVariants") or {}).get("thumbnail", {}),
+        "category": category or "Uncategorized",
+        "region": data.get("region") or region_of(data.get("location")),
+        "createdAt": created_at
+    }
+
+
+def _bump(counts: Dict, key: Optional[str], delta: int):
+    if not key:
+        return
+    value = counts.get(key, 0) + delta
+    if value > 0:
+        counts[key] = value
+    else:
+        counts.pop(key, None)
+
+
+def _story_ref(artisan_id: str, product_id: str):
+    return db.collection("product_stories").document(artisan_id).collection("products").document(product_id)
+
+
+def merged_summary(product_id: str, product: Optional[Dict], story: Optional[Dict]) -> Optional[Dict]:
+    """One card per productId: the product document with its generated story (if any) on top.
+
+    A story record without a product document still gets a card, so both sources
+    describe the same set of products whichever endpoint created them.
+    """
+    if not product and not story:
+        return None
+    card = product_summary(product_id, product or story)
+    generated = (story or {}).get("story")
+    if product and isinstance(generated, dict):
+        overrides = {"title": generated.get("Title"), "tagline": generated.get("Tagline"),
+                     "category": generated.get("Category")}
+        card.update({k: v for k, v in overrides.items() if v})
+    return card
+
+
+def _apply_delta(feed: Dict, before: Optional[Dict], after: Optional[Dict]):
+    category_counts = feed.setdefault("categoryCounts", {})
+    region_counts = feed.setdefault("regionCounts", {})
+    recent = feed.setdefault("recentByCategory", {})
+
+    if before:
+        _bump(category_counts, before["category"], -1)
+        _bump(region_counts, before["region"], -1)
+        feed["totalProducts"] = max(0, feed.get("totalProducts", 0) - 1)
+        cards = [c for c in recent.get(before["category"], []) if c["productId"] != before["productId"]]
+        if cards:
+            recent[before["category"]] = cards
+        else:
+            recent.pop(before["category"], None)
+
+    if after:
+        _bump(category_counts, after["category"], 1)
+        _bump(region_counts, after["region"], 1)
+        feed["totalProducts"] = feed.get("totalProducts", 0) + 1
+        cards = [c for c in recent.get(after["category"], []) if c["productId"] != after["productId"]]
+        cards.append(after)
+        cards.sort(key=lambda c: str(c.get("createdAt", "")), reverse=True)
+        recent[after["category"]] = cards[:FEED_TOP_N]
+
+
+@firestore.transactional
+def _sync_in_transaction(transaction, product_id: str, artisan_id: Optional[str]):
+    card_ref = db.collection(CARDS_COLLECTION).document(product_id)
+    card_snapshot = card_ref.get(transaction=transaction)
+    shard_ref = _shard_ref(_shard_of(product_id))
+    feed_snapshot = shard_ref.get(transaction=transaction)
+    product_snapshot = db.collection("products").document(product_id).get(transaction=transaction)
+    product = product_snapshot.to_dict() if product_snapshot.exists else None
+    before = card_snapshot.to_dict() if card_snapshot.exists else None
+    # An existing product decides whose story may decorate its card; the caller's id only
+    # locates story-only records
+    if product:
+        artisan_id = product.get("artisanId")
+    else:
+        artisan_id = artisan_id or (before or {}).get("artisanId")
+    story = None
+    if artisan_id:
+        story_snapshot = _story_ref(artisan_id, product_id).get(transaction=transaction)
+        story = story_snapshot.to_dict() if story_snapshot.exists else None
+
+    after = merged_summary(product_id, product, story)
+    feed = feed_snapshot.to_dict() if feed_snapshot.exists else _empty_feed()
+    _apply_delta(feed, before, after)
+    feed["updatedAt"] = datetime.datetime.utcnow().isoformat()
+    transaction.set(shard_ref, feed)
+    if after:
+        transaction.set(card_ref, after)
+    elif before:
+        transaction.delete(card_ref)
+
+
+def sync_product(product_id: str, artisan_id: Optional[str] = None):
+    """Re-derives a product's card from its current documents and folds the difference into the feed.
+
+    Call after any write to a product or its story record; `artisan_id` is only used when
+    there is no product document. The last card folded in is
+    kept in `discovery_cards`, so the update is idempotent and a missed sync is fixed by
+    the next one for that product. Failures never fail the write that triggered them:
+    the product is recorded in PENDING_COLLECTION for `retry_failed_syncs`.
+    """
+    try:
+        _sync_in_transaction(db.transaction(), product_id, artisan_id)
+        return True
+    except Exception as e:
+        logger.error(f"Discovery feed update error for {product_id}: {e}")
+    try:
+        db.collection(PENDING_COLLECTION).document(product_id).set(
+            {"artisanId": artisan_id, "failedAt": datetime.datetime.utcnow().isoformat()}
+        )
+    except Exception as e:
+        logger.error(f"Could not record failed feed sync for {product_id}: {e}")
+    return False
+
+
+def retry_failed_syncs(limit: int = 100) -> int:
+    """Re-runs syncs recorded by `sync_product` failures; returns how many were repaired."""
+    repaired = 0
+    for doc in db.collection(PENDING_COLLECTION).limit(limit).stream():
+        try:
+            _sync_in_transaction(db.transaction(), doc.id, (doc.to_dict() or {}).get("artisanId"))
+        except Exception as e:
+            logger.warning(f"Discovery feed retry failed for {doc.id}: {e}")
+            continue
+        try:
+            # Kept if the sync failed again after we read the marker
+            doc.reference.delete(option=db.write_option(last_update_time=doc.update_time))
+        except Exception:
+            continue
+        repaired += 1
+    return repaired
+
+
+def _merge_shards(shards: List[Dict]) -> Dict:
+    feed = _empty_feed()
+    updated = [shard["updatedAt"] for shard in shards if shard.get("updatedAt")]
+    for shard in shards:
+        feed["totalProducts"] += shard.get("totalProducts", 0)
+        for field in ("categoryCounts", "regionCounts"):
+            for key, count in shard.get(field, {}).items():
+                _bump(feed[field], key, count)
+        for category, cards in shard.get("recentByCategory", {}).items():
+            feed["recentByCategory"].setdefault(category, []).extend(cards)
+    for category, cards in feed["recentByCategory"].items():
+        cards.sort(key=lambda c: str(c.get("createdAt", "")), reverse=True)
+        feed["recentByCategory"][category] = cards[:FEED_TOP_N]
+    feed["updatedAt"] = max(updated) if updated else None
+    return feed
+
+
+def get_feed() -> Dict:
+    """Returns the feed merged from its shard documents, served from a short-lived in-process cache."""
+    global _cached_feed, _cached_at
+    with _cache_lock:
+        if _cached_feed is not None and time.monotonic() - _cached_at < FEED_CACHE_TTL_SECONDS:
+            return _cached_feed
+    snapshots = db.get_all([_shard_ref(shard) for shard in range(FEED_SHARDS)])
+    feed = _merge_shards([snapshot.to_dict() for snapshot in snapshots if snapshot.exists])
+    with _cache_lock:
+        _cached_feed, _cached_at = feed, time.monotonic()
+    return feed
+
+
+def rebuild_feed() -> Dict:
+    """Recomputes the feed and every card from `products` plus story records; for backfill or repair."""
+    global _cached_feed, _cached_at
+    sources: Dict[str, Dict] = {}
+    # Both the root `products` collection and product_stories/{uid}/products share the id
+    for doc in db.collection_group("products").stream():
+        entry = sources.setdefault(doc.id, {"stories": {}})
+        owner = doc.reference.parent.parent
+        if owner is None:
+            entry["product"] = doc.to_dict()
+        else:
+            entry["stories"][owner.id] = doc.to_dict()
+
+    shards = [_empty_feed() for _ in range(FEED_SHARDS)]
+    cards_ref = db.collection(CARDS_COLLECTION)
+    batch, pending = db.batch(), 0
+    for product_id, entry in sources.items():
+        # Same rule as sync_product: only the product's own artisan's story decorates it
+        product, stories = entry.get("product"), entry["stories"]
+        story = stories.get(product.get("artisanId")) if product else stories[min(stories)]
+        card = merged_summary(product_id, product, story)
+        shard = shards[_shard_of(product_id)]
+        _bump(shard["categoryCounts"], card["category"], 1)
+        _bump(shard["regionCounts"], card["region"], 1)
+        shard["totalProducts"] += 1
+        shard["recentByCategory"].setdefault(card["category"], []).append(card)
+        batch.set(cards_ref.document(product_id), card)
+        pending += 1
+        if pending == 500:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    # Cards of products that no longer exist
+    for doc in cards_ref.select([]).stream():
+        if doc.id not in sources:
+            batch.delete(doc.reference)
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+
+    updated_at = datetime.datetime.utcnow().isoformat()
+    batch = db.batch()
+    for index, shard in enumerate(shards):
+        for category, cards in shard["recentByCategory"].items():
+            cards.sort(key=lambda c: str(c.get("createdAt", "")), reverse=True)
+            shard["recentByCategory"][category] = cards[:FEED_TOP_N]
+        shard["updatedAt"] = updated_at
+        batch.set(_shard_ref(index), shard)
+    # The pre-sharding single document is no longer read
+    batch.delete(db.collection(FEED_COLLECTION).document(FEED_DOCUMENT))
+    batch.commit()
+
+    feed = _merge_shards(shards)
+    with _cache_lock:
+        _cached_feed, _cached_at = feed, time.monotonic()
+    logger.info(f"Discovery feed rebuilt from {feed['totalProducts']} products")
+    return feed
@@ -0,0 +1,385 @@
+# services/embedding_index.py
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "384"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")  # e.g. "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_INDEX_DIR = os.getenv("EMBEDDING_INDEX_DIR", "data/embeddings")
+# Product ids whose text changed outside the API (e.g. the story backfill), for the server to re-embed
+REINDEX_COLLECTION = "embedding_reindex"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+# --- Embedders ---
+class HashingEmbedder:
+    """Deterministic stand-in embedder: signed feature hashing of unigrams and bigrams.
+
+    Needs no model download and produces the same vector for the same text on every
+    machine, so the persisted index stays valid across restarts and deployments.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def _bucket(self, token: str) -> Tuple[int, float]:
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dim, 1.0 if (value >> 63) & 1 else -1.0
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = _TOKEN_RE.findall((text or "").lower())
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                col, sign = self._bucket(feature)
+                out[row, col] += sign
+        return _normalize(out)
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedder backed by sentence-transformers (optional dependency)."""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=32, convert_to_numpy=True)
+        return _normalize(vectors.astype(np.float32, copy=False))
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _load_embedder():
+    if EMBEDDING_MODEL:
+        try:
+            embedder = SentenceTransformerEmbedder(EMBEDDING_MODEL)
+            logger.info(f"Loaded embedding model {EMBEDDING_MODEL} (dim={embedder.dim})")
+            return embedder
+        except Exception as e:
+            logger.warning(f"Could not load embedding model {EMBEDDING_MODEL}, using hashing embedder: {e}")
+    return HashingEmbedder(EMBEDDING_DIM)
+
+
+# --- Index ---
+class EmbeddingIndex:
+    """Contiguous float32 matrix of unit vectors with batched cosine top-k.
+
+    Persisted as two append-only logs, a raw `vectors.f32` file and an `ids.jsonl` file,
+    one row per write: an update appends a new row for the id and a removal appends a
+    zero row, so rows on disk are never rewritten. Every uvicorn worker (and CLI) holds
+    its own copy; writers serialize on an exclusive `flock` of `index.lock`, and each
+    process reads rows appended by others before it searches or writes.
+    """
+
+    def __init__(self, dim: int, directory: Optional[str] = None, initial_capacity: int = 1024):
+        self.dim = dim
+        self.directory = directory
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._dead: set = set()
+        # How far into ids.jsonl this process has read
+        self._ids_offset = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.f32")
+
+    @property
+    def _ids_path(self) -> str:
+        return os.path.join(self.directory, "ids.jsonl")
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        with open(os.path.join(self.directory, "index.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, item_id: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return item_id in self._rows
+
+    def _load(self):
+        with self._lock, self._file_lock(exclusive=True):
+            self._read_tail()
+            self._trim_tail()
+        if self._ids:
+            logger.info(f"Loaded {len(self._ids)} embedding rows ({len(self._rows)} live) from {self.directory}")
+
+    def _read_tail(self):
+        """Applies complete rows appended to the files since this process last read them."""
+        if not (os.path.exists(self._vectors_path) and os.path.exists(self._ids_path)):
+            return
+        with open(self._ids_path, "rb") as f:
+            f.seek(self._ids_offset)
+            data = f.read()
+        lines = data[: data.rfind(b"\n") + 1].splitlines(keepends=True)
+        row_bytes = self.dim * 4
+        start = len(self._ids)
+        # Vectors are appended before ids, so a complete id line normally has its row
+        count = min(len(lines), max(0, os.path.getsize(self._vectors_path) // row_bytes - start))
+        if count == 0:
+            return
+        with open(self._vectors_path, "rb") as f:
+            f.seek(start * row_bytes)
+            vectors = np.frombuffer(f.read(count * row_bytes), dtype=np.float32).reshape(count, self.dim)
+        self._apply_rows([json.loads(line) for line in lines[:count]], vectors)
+        self._ids_offset += sum(len(line) for line in lines[:count])
+
+    def _trim_tail(self):
+        """Cuts a crashed writer's partial rows off both files (caller holds the exclusive lock)."""
+        row_bytes = self.dim * 4
+        for path, size in ((self._vectors_path, len(self._ids) * row_bytes), (self._ids_path, self._ids_offset)):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                logger.warning(f"Embedding index file {path} has a partial tail; trimming to {size} bytes")
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def _refresh(self):
+        if self.directory and os.path.exists(self._ids_path) and os.path.getsize(self._ids_path) != self._ids_offset:
+            with self._file_lock(exclusive=False):
+                self._read_tail()
+
+    def _apply_rows(self, item_ids: List[str], vectors: np.ndarray):
+        start = len(self._ids)
+        self._ensure_capacity(start + len(item_ids))
+        self._matrix[start: start + len(item_ids)] = vectors
+        self._ids.extend(item_ids)
+        for row, (item_id, vector) in enumerate(zip(item_ids, vectors), start):
+            previous = self._rows.pop(item_id, None)
+            if previous is not None:
+                self._dead.add(previous)
+            if vector.any():
+                self._rows[item_id] = row
+            else:
+                # Zero rows are removals
+                self._dead.add(row)
+
+    def _append(self, item_ids: List[str], vectors: np.ndarray):
+        if not self.directory:
+            self._apply_rows(item_ids, vectors)
+            return
+        with self._file_lock(exclusive=True):
+            self._read_tail()
+            self._trim_tail()
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._ids_path, "ab") as f:
+                f.write("".join(json.dumps(item_id) + "\n" for item_id in item_ids).encode("utf-8"))
+            self._apply_rows(item_ids, vectors)
+            self._ids_offset = os.path.getsize(self._ids_path)
+
+    def _ensure_capacity(self, size: int):
+        capacity = self._matrix.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[: len(self._ids)] = self._matrix[: len(self._ids)]
+        self._matrix = grown
+
+    def upsert(self, item_ids: List[str], vectors: np.ndarray):
+        """Adds or replaces rows for `item_ids`; `vectors` must be unit-normalized."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(item_ids):
+            with self._lock:
+                self._append(list(item_ids), vectors)
+
+    def remove(self, item_id: str):
+        """Tombstones an item with a zero row; search skips it."""
+        with self._lock:
+            self._refresh()
+            if item_id in self._rows:
+                self._append([item_id], np.zeros((1, self.dim), dtype=np.float32))
+
+    def vector(self, item_id: str) -> Optional[np.ndarray]:
+        with self._lock:
+            self._refresh()
+            row = self._rows.get(item_id)
+            return None if row is None else self._matrix[row].copy()
+
+    def search(self, queries: np.ndarray, k: int = 10, exclude: Optional[List[str]] = None) -> List[List[Tuple[str, float]]]:
+        """Batched cosine top-k: one matrix product for all queries, then argpartition."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            self._refresh()
+            size = len(self._ids)
+            if size == 0:
+                return [[] for _ in range(len(queries))]
+            scores = queries @ self._matrix[:size].T
+            excluded_rows = list(self._dead)
+            if exclude:
+                excluded_rows += [self._rows[i] for i in exclude if i in self._rows]
+            if excluded_rows:
+                scores[:, excluded_rows] = -np.inf
+            k = min(k, size)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for q, candidates in enumerate(top):
+                ordered = candidates[np.argsort(-scores[q, candidates])]
+                results.append([
+                    (self._ids[row], float(scores[q, row]))
+                    for row in ordered if np.isfinite(scores[q, row])
+                ])
+            return results
+
+
+# --- Module-level singletons ---
+_embedder = None
+_index = None
+_init_lock = threading.Lock()
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        with _init_lock:
+            if _embedder is None:
+                _embedder = _load_embedder()
+    return _embedder
+
+
+def get_index() -> EmbeddingIndex:
+    global _index
+    if _index is None:
+        embedder = get_embedder()
+        with _init_lock:
+            if _index is None:
+                _index = EmbeddingIndex(embedder.dim, EMBEDDING_INDEX_DIR)
+    return _index
+
+
+def product_text(product: Dict) -> str:
+    """Text used to embed a product: title, tagline and story, whichever are present."""
+    story = product.get("story")
+    if isinstance(story, dict):
+        parts = [story.get(key) for key in ("Title", "Category", "Tagline", "Material", "Method", "CulturalSignificance")]
+    else:
+        parts = [product.get("title"), product.get("category"), product.get("tagline"), story]
+    return " ".join(str(p) for p in parts if p)
+
+
+def index_product(product_id: str, product: Dict):
+    """Embeds a product and upserts it into the index. Never raises; indexing is best-effort."""
+    try:
+        text = product_text(product)
+        if not text:
+            return
+        vectors = get_embedder().embed([text])
+        get_index().upsert([product_id], vectors)
+    except Exception as e:
+        logger.error(f"Embedding index error for {product_id}: {e}")
+
+
+def remove_product(product_id: str):
+    try:
+        get_index().remove(product_id)
+    except Exception as e:
+        logger.error(f"Embedding index removal error for {product_id}: {e}")
+
+
+def similar_products(product_id: str, k: int = 10) -> Optional[List[Tuple[str, float]]]:
+    """Returns the k nearest products to `product_id`, or None if it is not indexed."""
+    index = get_index()
+    query = index.vector(product_id)
+    if query is None:
+        return None
+    return index.search(query, k=k, exclude=[product_id])[0]
+
+
+def backfill_index(batch_size: int = 256) -> Dict[str, int]:
+    """Embeds every product that is not indexed yet, in batches (for products created before the index)."""
+    from firebase_admin import firestore
+
+    index = get_index()
+    stats = {"indexed": 0, "skipped": 0}
+    pending_ids, pending_texts = [], []
+
+    def flush():
+        if pending_ids:
+            index.upsert(pending_ids, get_embedder().embed(pending_texts))
+            stats["indexed"] += len(pending_ids)
+            pending_ids.clear()
+            pending_texts.clear()
+
+    query = firestore.client().collection("products").select(["title", "category", "tagline", "story"])
+    for doc in query.stream():
+        text = product_text(doc.to_dict())
+        if doc.id in index or not text:
+            stats["skipped"] += 1
+            continue
+        pending_ids.append(doc.id)
+        pending_texts.append(text)
+        if len(pending_ids) >= batch_size:
+            flush()
+    flush()
+    return stats
+
+
+def drain_reindex_queue(batch_size: int = 256) -> Dict[str, int]:
+    """Re-embeds the products queued in REINDEX_COLLECTION and clears their entries.
+
+    Offline jobs queue ids instead of writing the index themselves; the server drains the
+    queue at startup and on POST /admin/embeddings/reindex. A product's story record is
+    embedded when it has one, as the story endpoints do.
+    """
+    from firebase_admin import firestore
+
+    db = firestore.client()
+    stats = {"indexed": 0, "skipped": 0}
+    while True:
+        queued = list(db.collection(REINDEX_COLLECTION).limit(batch_size).stream())
+        if not queued:
+            return stats
+        entries = [(doc, doc.to_dict() or {}) for doc in queued]
+        story_refs = [
+            db.collection("product_stories").document(entry["artisanId"]).collection("products").document(doc.id)
+            for doc, entry in entries if entry.get("artisanId")
+        ]
+        stories = {snap.id: snap.to_dict() for snap in db.get_all(story_refs) if snap.exists}
+        missing = [db.collection("products").document(doc.id) for doc, _ in entries if doc.id not in stories]
+        products = {snap.id: snap.to_dict() for snap in db.get_all(missing) if snap.exists} if missing else {}
+        pending = {doc.id: stories.get(doc.id) or products.get(doc.id) for doc, _ in entries}
+        texts = {product_id: product_text(data) for product_id, data in pending.items() if data}
+        texts = {product_id: text for product_id, text in texts.items() if text}
+        if texts:
+            get_index().upsert(list(texts), get_embedder().embed(list(texts.values())))
+        stats["indexed"] += len(texts)
+        stats["skipped"] += len(entries) - len(texts)
+        batch = db.batch()
+        for doc, _ in entries:
+            batch.delete(doc.reference)
+        batch.commit()
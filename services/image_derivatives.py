@@ -0,0 +1,220 @@
+# services/image_derivatives.py
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from firebase_admin import firestore, storage
+
+from services.artisan_summaries import record_product_change
+from services.discovery_feed import sync_product
+from services.image_renditions import FORMATS, render_renditions
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+bucket = storage.bucket()
+
+# --- Configuration ---
+IMAGE_WORKERS = int(os.getenv("IMAGE_DERIVATIVE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Names are unique per upload, so renditions never change and can be cached forever
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Documents store blob paths; URLs are signed when served and reused for half their lifetime
+SIGNED_URL_TTL = timedelta(hours=int(os.getenv("IMAGE_SIGNED_URL_TTL_HOURS", "24")))
+SIGNED_URL_CACHE_SIZE = 10_000
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_upload_pool = ThreadPoolExecutor(max_workers=8)
+# Separate from _upload_pool: these tasks block on uploads and must not starve them
+_derivative_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+_signed_urls: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_signed_lock = threading.Lock()
+
+
+def _pool() -> ProcessPoolExecutor:
+    global _render_pool
+    if _render_pool is None:
+        # Forking a process that already runs gRPC/HTTP client threads can deadlock the child;
+        # spawned workers only import services.image_renditions, which needs no Firebase app
+        _render_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _render_pool
+
+
+def _upload(local_path: str, storage_path: str, content_type: str):
+    blob = bucket.blob(storage_path)
+    blob.cache_control = CACHE_CONTROL
+    blob.upload_from_filename(local_path, content_type=content_type)
+
+
+def generate_derivatives(image_path: str, storage_prefix: str, stem: str) -> Dict:
+    """Renders and uploads all renditions of a local image next to its original (blocking).
+
+    Returns {"imageVariants": {rendition: {"width", "webp", "jpeg"}}, "imageVariantPaths": [...]}
+    with blob paths as the format values; `signed_images` turns them into URLs when served.
+    """
+    work_dir = tempfile.mkdtemp(prefix="derivatives_")
+    try:
+        outputs = _pool().submit(render_renditions, image_path, work_dir, stem).result()
+        uploads = []
+        for name, fmt, path, width in outputs:
+            storage_path = f"{storage_prefix}/{os.path.basename(path)}"
+            future = _upload_pool.submit(_upload, path, storage_path, FORMATS[fmt][1])
+            uploads.append((name, fmt, width, storage_path, future))
+        variants: Dict[str, Dict] = {}
+        paths = []
+        for name, fmt, width, storage_path, future in uploads:
+            future.result()
+            variants.setdefault(name, {"width": width})[fmt] = storage_path
+            paths.append(storage_path)
+        return {"imageVariants": variants, "imageVariantPaths": paths}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def start_derivatives(image_path: str, storage_prefix: str, stem: str) -> Future:
+    """Starts `generate_derivatives` in the background so it overlaps other pipeline work."""
+    return _derivative_pool.submit(generate_derivatives, image_path, storage_prefix, stem)
+
+
+def signed_url(path: Optional[str]) -> Optional[str]:
+    """Signed URL for a blob path (or a legacy stored URL for this bucket)."""
+    if not path:
+        return path
+    if "://" in path:
+        blob_path = storage_path_from_url(path)
+        if not blob_path:
+            return path
+        path = blob_path
+    now = time.time()
+    with _signed_lock:
+        cached = _signed_urls.get(path)
+    if cached and cached[1] - now > SIGNED_URL_TTL.total_seconds() / 2:
+        return cached[0]
+    url = bucket.blob(path).generate_signed_url(expiration=SIGNED_URL_TTL)
+    with _signed_lock:
+        _signed_urls[path] = (url, now + SIGNED_URL_TTL.total_seconds())
+        _signed_urls.move_to_end(path)
+        while len(_signed_urls) > SIGNED_URL_CACHE_SIZE:
+            _signed_urls.popitem(last=False)
+    return url
+
+
+def _signed_rendition(rendition: Dict) -> Dict:
+    return {key: signed_url(value) if key in FORMATS else value for key, value in rendition.items()}
+
+
+def signed_images(data: Dict) -> Dict:
+    """Copy of a product, projection or feed card with its stored image paths signed for serving."""
+    signed = dict(data)
+    if data.get("imageUrl"):
+        signed["imageUrl"] = signed_url(data["imageUrl"])
+    if data.get("imageVariants"):
+        signed["imageVariants"] = {name: _signed_rendition(v) for name, v in data["imageVariants"].items()}
+    if data.get("thumbnail"):
+        signed["thumbnail"] = _signed_rendition(data["thumbnail"])
+    return signed
+
+
+def signed_list(items: List[Dict]) -> List[Dict]:
+    """`signed_images` over a list; lets a route sign a whole page in one threadpool hop."""
+    return [signed_images(item) for item in items]
+
+
+def srcset(variants: Optional[Dict]) -> Dict[str, str]:
+    """Builds {"webp": "url 200w, url 640w, ...", "jpeg": ...} from stored variants, signing each URL."""
+    if not variants:
+        return {}
+    ordered = sorted((_signed_rendition(v) for v in variants.values()), key=lambda v: v.get("width", 0))
+    return {
+        fmt: ", ".join(f"{v[fmt]} {v['width']}w" for v in ordered if v.get(fmt))
+        for fmt in FORMATS
+    }
+
+
+def storage_path_from_url(url: str) -> Optional[str]:
+    """Recovers the blob path from a signed or public URL for this bucket."""
+    marker = f"{bucket.name}/"
+    if not url or marker not in url:
+        return None
+    return url.split(marker, 1)[1].split("?", 1)[0]
+
+
+def _update_variants(doc, fields: Dict):
+    """Writes backfilled variants through the summary transaction and refreshes the feed card,
+    so `artisan_summaries.latestProducts` and `discovery_cards` pick up the new thumbnail."""
+    artisan_id = doc.to_dict().get("artisanId")
+    if not artisan_id:
+        doc.reference.update(fields)
+        return
+    record_product_change(artisan_id, doc.id, ("update", fields))
+    sync_product(doc.id, artisan_id)
+
+
+def backfill_product(doc) -> bool:
+    """Generates renditions for one existing product document; returns True if updated."""
+    data = doc.to_dict()
+    source = storage_path_from_url(data.get("imageUrl"))
+    if not source:
+        logger.warning(f"Skipping {doc.id}: cannot resolve image path")
+        return False
+    prefix, filename = source.rsplit("/", 1)
+    stem, ext = os.path.splitext(filename)
+    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as temp_file:
+        temp_path = temp_file.name
+    try:
+        bucket.blob(source).download_to_filename(temp_path)
+        _update_variants(doc, generate_derivatives(temp_path, prefix, stem))
+        return True
+    finally:
+        os.unlink(temp_path)
+
+
+def _legacy_variant_paths(variants: Dict) -> Optional[Dict]:
+    """Variants stored as signed URLs by older builds, rewritten as blob paths (None if already paths)."""
+    if not any("://" in str(v.get(fmt, "")) for v in variants.values() for fmt in FORMATS):
+        return None
+    return {
+        name: {key: storage_path_from_url(value) if key in FORMATS and "://" in str(value) else value
+               for key, value in v.items()}
+        for name, v in variants.items()
+    }
+
+
+def backfill_all(limit: Optional[int] = None, concurrency: int = 4) -> Dict[str, int]:
+    """Backfills renditions for every product that has none yet.
+
+    Products whose variants were stored as signed URLs are rewritten to blob paths in place.
+    Each write also refreshes the product's artisan summary and discovery card.
+    """
+    stats = {"updated": 0, "migrated": 0, "skipped": 0, "failed": 0}
+    pending = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for doc in db.collection("products").stream():
+            if limit is not None and len(pending) >= limit:
+                break
+            data = doc.to_dict()
+            legacy = _legacy_variant_paths(data.get("imageVariants") or {})
+            if legacy is not None:
+                _update_variants(doc, {"imageVariants": legacy})
+                stats["migrated"] += 1
+                continue
+            if data.get("imageVariants") or not data.get("imageUrl"):
+                stats["skipped"] += 1
+                continue
+            pending.append((doc.id, pool.submit(backfill_product, doc)))
+        for product_id, future in pending:
+            try:
+                stats["updated" if future.result() else "skipped"] += 1
+            except Exception as e:
+                logger.error(f"Derivative backfill failed for {product_id}: {e}")
+                stats["failed"] += 1
+    return stats
@@ -0,0 +1,39 @@
+# services/image_renditions.py
+
+# Pure-Pillow rendering, kept free of Firebase imports so spawned worker processes can load it.
+
+import os
+from typing import List, Tuple
+
+from PIL import Image, ImageOps
+
+# --- Configuration ---
+# Rendition name -> longest edge in pixels, smallest first
+RENDITIONS = [("thumbnail", 200), ("medium", 640), ("large", 1280)]
+FORMATS = {"webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+           "jpeg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True})}
+
+
+def render_renditions(image_path: str, out_dir: str, stem: str) -> List[Tuple[str, str, str, int]]:
+    """Decodes once and writes every rendition; runs in a worker process.
+
+    Returns (rendition, format, local path, width) tuples. Renditions larger than the
+    original are skipped rather than upscaled, except the thumbnail.
+    """
+    with Image.open(image_path) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    longest = max(image.size)
+    outputs = []
+    # Downscale from the largest rendition to the smallest, reusing each result
+    current = image
+    for name, edge in reversed(RENDITIONS):
+        if edge > longest and name != RENDITIONS[0][0]:
+            continue
+        resized = current.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)
+        current = resized
+        for fmt, (pil_format, _, options) in FORMATS.items():
+            path = os.path.join(out_dir, f"{stem}_{name}.{'jpg' if fmt == 'jpeg' else fmt}")
+            resized.save(path, pil_format, **options)
+            outputs.append((name, fmt, path, resized.width))
+    return outputs
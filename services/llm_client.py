@@ -0,0 +1,235 @@
+# services/llm_client.py
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "45"))
+# Share of the deadline the primary model gets when a fallback is configured
+LLM_PRIMARY_BUDGET_SHARE = float(os.getenv("LLM_PRIMARY_BUDGET_SHARE", "0.6"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE", "1") == "1"
+# Hedge after the model's observed p95, clamped to this range; default until enough samples exist
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", "2"))
+LLM_HEDGE_DEFAULT_SECONDS = float(os.getenv("LLM_HEDGE_DEFAULT_SECONDS", "12"))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "32"))
+LATENCY_WINDOW = 200
+
+# One pooled, keep-alive HTTP client shared by every model (connections to OpenRouter are reused)
+_http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=LLM_MAX_INFLIGHT, max_keepalive_connections=LLM_MAX_INFLIGHT // 2),
+    timeout=httpx.Timeout(LLM_DEADLINE_SECONDS, connect=5.0)
+)
+# Calls run here so the caller can stop waiting at its deadline; abandoned calls end at the HTTP timeout
+_call_pool = ThreadPoolExecutor(max_workers=LLM_MAX_INFLIGHT, thread_name_prefix="llm")
+
+
+class LLMUnavailableError(Exception):
+    """Every candidate model failed, timed out or has an open circuit."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LatencyStats:
+    """Rolling latency window and outcome counters for one model."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.counts = {"success": 0, "error": 0, "timeout": 0, "hedged": 0, "hedgeWins": 0}
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def count(self, outcome: str):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            ordered = sorted(self._latencies)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def samples(self) -> int:
+        return len(self._latencies)
+
+    def snapshot(self) -> Dict:
+        p50, p95, p99 = (self.percentile(q) for q in (0.5, 0.95, 0.99))
+        return {
+            "samples": self.samples(),
+            "p50": p50 and round(p50, 3),
+            "p95": p95 and round(p95, 3),
+            "p99": p99 and round(p99, 3),
+            **self.counts
+        }
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; after the reset timeout one probe call is let through."""
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, reset_seconds: float = LLM_BREAKER_RESET_SECONDS):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self._consecutive = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_after(self) -> float:
+        if self._opened_at is None:
+            return 0.0
+        return max(1.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or self._consecutive >= self.failures:
+                if self._opened_at is None or self._probing:
+                    logger.warning(f"LLM circuit opened after {self._consecutive} consecutive failures")
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class ResilientLLM:
+    """Chat model wrapper with a per-call deadline, hedged requests, circuit breaking and fallback.
+
+    A call goes to the primary model; if it hasn't answered by that model's p95 latency,
+    an identical request is raced against it and the first answer wins. Failures and
+    timeouts feed a per-model circuit breaker; while the primary's circuit is open (or
+    after it fails) the fallback model, if any, is tried with the remaining budget.
+    """
+
+    def __init__(self, primary: str, fallback: Optional[str] = None, **chat_kwargs):
+        self.candidates: List[str] = [primary] + ([fallback] if fallback and fallback != primary else [])
+        self._models = {
+            name: ChatOpenAI(model=name, http_client=_http_client, timeout=LLM_DEADLINE_SECONDS,
+                             max_retries=0, **chat_kwargs)
+            for name in self.candidates
+        }
+        self._stats = {name: LatencyStats() for name in self.candidates}
+        self._breakers = {name: CircuitBreaker() for name in self.candidates}
+
+    def invoke(self, messages, deadline: Optional[float] = None, hedge: bool = True):
+        """Returns the first successful response within `deadline` seconds, else raises LLMUnavailableError.
+
+        `hedge=False` never sends a duplicate request, for batch callers that budget every call.
+        """
+        expires = time.monotonic() + (deadline or LLM_DEADLINE_SECONDS)
+        last_error: Optional[Exception] = None
+        for i, name in enumerate(self.candidates):
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                break
+            breaker = self._breakers[name]
+            if not breaker.allow():
+                continue
+            # Leave part of the budget for the fallback when there is one
+            if i < len(self.candidates) - 1:
+                remaining *= LLM_PRIMARY_BUDGET_SHARE
+            try:
+                response = self._hedged_call(name, messages, remaining, hedge)
+            except Exception as e:
+                breaker.record_failure()
+                last_error = e
+                logger.warning(f"LLM call to {name} failed: {e!r}")
+                continue
+            breaker.record_success()
+            return response
+
+        retry_after = min(b.retry_after() for b in self._breakers.values()) or 1.0
+        raise LLMUnavailableError(f"No LLM available: {last_error!r}" if last_error else "All LLM circuits open",
+                                  retry_after)
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        stats = self._stats[name]
+        if not LLM_HEDGE_ENABLED:
+            return None
+        if stats.samples() < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DEFAULT_SECONDS
+        return max(LLM_HEDGE_MIN_SECONDS, stats.percentile(0.95))
+
+    def _timed_call(self, name: str, messages):
+        start = time.monotonic()
+        response = self._models[name].invoke(messages)
+        self._stats[name].record(time.monotonic() - start)
+        return response
+
+    def _hedged_call(self, name: str, messages, budget: float, allow_hedge: bool = True):
+        stats = self._stats[name]
+        start = time.monotonic()
+        hedge_at = self._hedge_delay(name) if allow_hedge else None
+        hedge = None
+        pending = {_call_pool.submit(self._timed_call, name, messages)}
+        last_error: Optional[Exception] = None
+        while pending:
+            elapsed = time.monotonic() - start
+            timeout = budget - elapsed
+            if hedge is None and hedge_at is not None and hedge_at < budget:
+                timeout = min(timeout, max(0.0, hedge_at - elapsed))
+            done, pending = wait(pending, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    stats.count("error")
+                    last_error = e
+                    continue
+                stats.count("success")
+                if future is hedge:
+                    stats.count("hedgeWins")
+                return response
+            elapsed = time.monotonic() - start
+            if elapsed >= budget:
+                stats.count("timeout")
+                raise TimeoutError(f"{name} did not answer within {budget:.1f}s")
+            # Hedge only a slow call; an outright failure is the breaker's business, not a retry
+            if hedge is None and pending and hedge_at is not None and elapsed >= hedge_at:
+                hedge = _call_pool.submit(self._timed_call, name, messages)
+                pending.add(hedge)
+                stats.count("hedged")
+        raise last_error
+
+    def stats(self) -> Dict:
+        return {
+            name: {"circuit": self._breakers[name].state, **self._stats[name].snapshot()}
+            for name in self.candidates
+        }
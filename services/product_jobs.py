@@ -0,0 +1,275 @@
+# services/product_jobs.py
+
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import time
+import uuid
+from datetime import datetime
+from typing import BinaryIO, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from firebase_admin import firestore
+
+from services.product_pipeline import create_product_from_media, new_product_id, response_for_product, PipelineError
+from services.embedding_index import index_product
+from services.discovery_feed import sync_product
+from services.image_derivatives import signed_images
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+
+# --- Configuration ---
+JOB_COLLECTION = "product_jobs"
+JOB_WORKERS = int(os.getenv("PRODUCT_JOB_WORKERS", "2"))
+JOB_QUEUE_LIMIT = int(os.getenv("PRODUCT_JOB_QUEUE_LIMIT", "100"))
+JOB_SPOOL_DIR = os.getenv("PRODUCT_JOB_SPOOL_DIR", "data/job_spool")
+# Spooled media is local to this host, so only this host can resume its jobs
+HOST_ID = os.getenv("PRODUCT_JOB_HOST_ID", socket.gethostname())
+# Unique per process: several uvicorn workers on one host share HOST_ID
+WORKER_ID = f"{HOST_ID}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# A running job's claim expires unless its worker renews it; recovery only takes expired claims
+JOB_LEASE_SECONDS = float(os.getenv("PRODUCT_JOB_LEASE_SECONDS", "120"))
+
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+
+
+class JobQueueFull(Exception):
+    """Raised when the pending-job backlog is at PRODUCT_JOB_QUEUE_LIMIT."""
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def _job_ref(job_id: str):
+    return db.collection(JOB_COLLECTION).document(job_id)
+
+
+def _spool(job_id: str, src: BinaryIO, ext: str, kind: str) -> str:
+    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(JOB_SPOOL_DIR, f"{job_id}_{kind}{ext}")
+    with open(path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return path
+
+
+def _discard_spool(job: Dict):
+    for key in ("audioPath", "imagePath"):
+        path = job.get(key)
+        if path and os.path.exists(path):
+            os.unlink(path)
+
+
+async def submit_job(
+    uid: str,
+    user_data: Dict,
+    lang: str,
+    audio: BinaryIO,
+    audio_ext: str,
+    image: BinaryIO,
+    image_ext: str,
+    post_to_instagram: bool = False
+) -> str:
+    """Spools the uploaded media to local disk, records a queued job and enqueues it."""
+    if _queue is None:
+        raise RuntimeError("Product job workers are not running")
+    if _queue.qsize() >= JOB_QUEUE_LIMIT:
+        raise JobQueueFull()
+
+    job_id = f"job_{uuid.uuid4().hex}"
+    audio_path = await run_in_threadpool(_spool, job_id, audio, audio_ext, "audio")
+    image_path = await run_in_threadpool(_spool, job_id, image, image_ext, "image")
+    job = {
+        "jobId": job_id,
+        "artisanId": uid,
+        # Allocated up front so a rerun after a crash can see whether the product was written
+        "productId": new_product_id(),
+        "status": "queued",
+        "stage": "queued",
+        "stages": {"queued": _now()},
+        "lang": lang,
+        "postToInstagram": post_to_instagram,
+        "artisanLocation": user_data.get("location") or user_data.get("address"),
+        "host": HOST_ID,
+        "audioPath": audio_path,
+        "audioExt": audio_ext,
+        "imagePath": image_path,
+        "imageExt": image_ext,
+        "createdAt": _now(),
+        "updatedAt": _now()
+    }
+    await run_in_threadpool(_job_ref(job_id).set, job)
+    _queue.put_nowait(job_id)
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    snapshot = _job_ref(job_id).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+def public_job_view(job: Dict) -> Dict:
+    """Job fields exposed to clients (no local spool paths; image paths signed for serving)."""
+    return {
+        "jobId": job["jobId"],
+        "status": job.get("status"),
+        "stage": job.get("stage"),
+        "stages": job.get("stages", {}),
+        "result": signed_images(job["result"]) if job.get("result") else None,
+        "error": job.get("error"),
+        "createdAt": job.get("createdAt"),
+        "updatedAt": job.get("updatedAt")
+    }
+
+
+def _written_product(job: Dict) -> Optional[Dict]:
+    """The job's product document if an earlier attempt already saved it."""
+    if not job.get("productId"):
+        return None
+    snapshot = db.collection("products").document(job["productId"]).get()
+    return snapshot.to_dict() if snapshot.exists else None
+
+
+@firestore.transactional
+def _claim_in_transaction(transaction, job_ref) -> Optional[Dict]:
+    snapshot = job_ref.get(transaction=transaction)
+    job = snapshot.to_dict() if snapshot.exists else None
+    if job is None or job.get("status") != "queued":
+        return None
+    transaction.update(job_ref, {"status": "running", "owner": WORKER_ID,
+                                 "leaseUntil": time.time() + JOB_LEASE_SECONDS, "updatedAt": _now()})
+    return job
+
+
+def _claim(job_id: str) -> Optional[Dict]:
+    """Atomically moves a queued job to running under this process; None if another worker has it."""
+    return _claim_in_transaction(db.transaction(), _job_ref(job_id))
+
+
+def _renew_lease(job_id: str):
+    _job_ref(job_id).update({"leaseUntil": time.time() + JOB_LEASE_SECONDS})
+
+
+def _run_job(job_id: str):
+    """Executes one job in a worker thread, recording each stage transition."""
+    job_ref = _job_ref(job_id)
+    job = _claim(job_id)
+    if job is None:
+        return
+
+    def on_stage(stage: str):
+        job_ref.update({"status": "running", "stage": stage, f"stages.{stage}": _now(), "updatedAt": _now()})
+
+    try:
+        existing = _written_product(job)
+        if existing is not None:
+            # A previous run crashed after the product write; finish instead of duplicating it
+            logger.info(f"Product job {job_id} resumed after save of {job['productId']}")
+            index_product(job["productId"], existing)
+            sync_product(job["productId"], job["artisanId"])
+            job_ref.update({"status": "succeeded", "stage": "done", "stages.done": _now(),
+                            "result": response_for_product(job["productId"], existing), "updatedAt": _now()})
+            return
+        result = create_product_from_media(
+            job["artisanId"],
+            {"location": job.get("artisanLocation")},
+            job["lang"],
+            job["audioPath"],
+            job["imagePath"],
+            job.get("audioExt", ""),
+            job.get("imageExt", ""),
+            post_to_instagram=job.get("postToInstagram", False),
+            on_stage=on_stage,
+            product_id=job.get("productId")
+        )
+        job_ref.update({"status": "succeeded", "stage": "done", "stages.done": _now(), "result": result, "updatedAt": _now()})
+    except PipelineError as e:
+        job_ref.update({"status": "failed", "error": str(e), "updatedAt": _now()})
+    except Exception as e:
+        logger.error(f"Product job {job_id} failed: {e}")
+        job_ref.update({"status": "failed", "error": f"An error occurred: {str(e)}", "updatedAt": _now()})
+    finally:
+        _discard_spool(job)
+
+
+async def _heartbeat(job_id: str):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await run_in_threadpool(_renew_lease, job_id)
+        except Exception as e:
+            logger.warning(f"Product job {job_id} lease renewal failed: {e}")
+
+
+async def _worker(index: int):
+    while True:
+        job_id = await _queue.get()
+        heartbeat = asyncio.create_task(_heartbeat(job_id))
+        try:
+            await run_in_threadpool(_run_job, job_id)
+        except Exception as e:
+            logger.error(f"Product job worker {index} error on {job_id}: {e}")
+        finally:
+            heartbeat.cancel()
+            _queue.task_done()
+
+
+@firestore.transactional
+def _requeue_in_transaction(transaction, job_ref) -> bool:
+    """Resets a running job whose claim expired (its worker died) back to queued."""
+    snapshot = job_ref.get(transaction=transaction)
+    job = snapshot.to_dict() if snapshot.exists else {}
+    if job.get("status") != "running" or job.get("leaseUntil", 0) > time.time():
+        return job.get("status") == "queued"
+    transaction.update(job_ref, {"status": "queued", "stage": "queued", "owner": None, "updatedAt": _now()})
+    return True
+
+
+def _recover_pending() -> List[str]:
+    """Finds this host's queued jobs and running jobs whose worker died; returns ids to enqueue.
+
+    Sibling workers on the host may enqueue the same ids; `_claim` lets exactly one run each.
+    Jobs still held under a live lease are left to their owner.
+    """
+    requeue = []
+    for doc in db.collection(JOB_COLLECTION).where("status", "in", ["queued", "running"]).stream():
+        job = doc.to_dict()
+        if job.get("host") != HOST_ID:
+            continue
+        if job["status"] == "running" and job.get("leaseUntil", 0) > time.time():
+            continue
+        media_survived = all(job.get(k) and os.path.exists(job[k]) for k in ("audioPath", "imagePath"))
+        if media_survived or _written_product(job) is not None:
+            if _requeue_in_transaction(db.transaction(), doc.reference):
+                requeue.append(doc.id)
+        else:
+            doc.reference.update({"status": "failed", "error": "Job interrupted; please resubmit", "updatedAt": _now()})
+    return requeue
+
+
+async def start_workers():
+    global _queue
+    if _queue is not None:
+        return
+    _queue = asyncio.Queue()
+    try:
+        for job_id in await run_in_threadpool(_recover_pending):
+            _queue.put_nowait(job_id)
+    except Exception as e:
+        logger.error(f"Product job recovery failed: {e}")
+    for i in range(JOB_WORKERS):
+        _workers.append(asyncio.create_task(_worker(i)))
+    logger.info(f"Started {JOB_WORKERS} product job workers ({_queue.qsize()} recovered jobs)")
+
+
+async def stop_workers():
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queue = None
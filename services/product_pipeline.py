@@ -0,0 +1,146 @@
+# services/product_pipeline.py
+
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from firebase_admin import firestore, storage
+
+from services.transcribe_audio import transcribe_audio, translation_is_identity
+from services.embedding_index import index_product
+from services.discovery_feed import region_of, sync_product
+from services.image_derivatives import start_derivatives
+from services.artisan_summaries import record_product_change
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+bucket = storage.bucket()
+
+# Stages reported through `on_stage`, in order
+STAGES = ["uploading", "transcribing", "translating", "saving"]
+
+
+# Product fields echoed back as `generatedContent`
+GENERATED_FIELDS = ["title", "tagline", "story", "native_title", "native_tagline", "native_story", "category"]
+
+
+class PipelineError(Exception):
+    """A pipeline failure whose message is safe to show to the client."""
+
+
+def new_product_id() -> str:
+    return f"prod_{uuid.uuid4().hex}"
+
+
+def response_for_product(product_id: str, product: Dict) -> Dict:
+    """Rebuilds the pipeline's response body from a stored product document."""
+    return {
+        "message": "Product created successfully with AI!",
+        "productId": product_id,
+        "generatedContent": {f: product.get(f) for f in GENERATED_FIELDS},
+        "imageVariants": product.get("imageVariants", {})
+    }
+
+
+def create_product_from_media(
+    uid: str,
+    user_data: Dict,
+    lang: str,
+    audio_path: str,
+    image_path: str,
+    audio_ext: str,
+    image_ext: str,
+    post_to_instagram: bool = False,
+    on_stage: Optional[Callable[[str], None]] = None,
+    product_id: Optional[str] = None
+) -> Dict:
+    """Runs the /products/generate pipeline over media already on local disk (blocking).
+
+    Used directly by the synchronous endpoint (in the threadpool) and by the job workers.
+    Jobs pass a pre-allocated `product_id` so a rerun can tell the product was already
+    written. Returns the endpoint's response body.
+    """
+    report = on_stage or (lambda stage: None)
+
+    # Upload files to Firebase Storage
+    report("uploading")
+    audio_storage_path = f"product-audio/{uid}/{uuid.uuid4()}{audio_ext}"
+    image_stem = str(uuid.uuid4())
+    image_storage_path = f"product-images/{uid}/{image_stem}{image_ext}"
+
+    audio_blob = bucket.blob(audio_storage_path)
+    image_blob = bucket.blob(image_storage_path)
+    audio_blob.upload_from_filename(audio_path)
+    image_blob.upload_from_filename(image_path)
+
+    audio_url = audio_blob.generate_signed_url(expiration=timedelta(days=7))
+    image_url = image_blob.generate_signed_url(expiration=timedelta(days=7))
+
+    # Listing renditions are rendered in the background while Whisper runs
+    derivatives = start_derivatives(image_path, f"product-images/{uid}", image_stem)
+
+    # Run transcription (native) and translation (English)
+    report("transcribing")
+    native_text = transcribe_audio(audio_path, lang, task="transcribe")
+    report("translating")
+    if translation_is_identity(lang):
+        english_text = native_text
+    else:
+        english_text = transcribe_audio(audio_path, lang, task="translate")
+
+    if native_text is None or english_text is None:
+        raise PipelineError("Audio processing failed")
+
+    # Placeholder for Vision AI and Gemini integration
+    generated_content = {
+        "title": native_text[:50],
+        "tagline": english_text[:100],
+        "story": english_text,
+        "native_title": native_text[:50],
+        "native_tagline": native_text[:100],
+        "native_story": native_text,
+        "category": "Craft"
+    }
+
+    # Save to Firestore products collection
+    report("saving")
+    try:
+        image_derivatives = derivatives.result()
+    except Exception as e:
+        # Listings fall back to the original image
+        logger.error(f"Image derivative generation failed: {e}")
+        image_derivatives = {"imageVariants": {}, "imageVariantPaths": []}
+    product_id = product_id or new_product_id()
+    product_entry = {
+        "productId": product_id,
+        "artisanId": uid,
+        "title": generated_content["title"],
+        "tagline": generated_content["tagline"],
+        "story": generated_content["story"],
+        "native_title": generated_content["native_title"],
+        "native_tagline": generated_content["native_tagline"],
+        "native_story": generated_content["native_story"],
+        "category": generated_content["category"],
+        "imageUrl": image_url,
+        **image_derivatives,
+        "audioUrl": audio_url,
+        "lang": lang,
+        "region": region_of(user_data.get("location") or user_data.get("address")),
+        "createdAt": datetime.utcnow().isoformat(),
+        "timestamp": firestore.SERVER_TIMESTAMP
+    }
+    record_product_change(uid, product_id, ("set", product_entry))
+    index_product(product_id, product_entry)
+    sync_product(product_id, uid)
+
+    # Placeholder for Instagram posting
+    if post_to_instagram:
+        logger.info("Instagram posting not implemented yet")
+
+    return {
+        "message": "Product created successfully with AI!",
+        "productId": product_id,
+        "generatedContent": generated_content,
+        "imageVariants": image_derivatives["imageVariants"]
+    }
@@ -0,0 +1,282 @@
+# services/story_backfill.py
+
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional
+
+from firebase_admin import firestore
+
+from services.discovery_feed import rebuild_feed
+from services.embedding_index import REINDEX_COLLECTION
+from services.image_derivatives import bucket, storage_path_from_url
+from services.llm_client import LLMUnavailableError
+from services.story_services import generate_story_from_details, story_ref, upload_story_copy
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+
+# --- Configuration ---
+CHECKPOINT_PATH = os.getenv("STORY_BACKFILL_CHECKPOINT", "data/story_backfill_checkpoint.json")
+# Firestore allows 500 writes per batch; each story also queues its product for re-embedding
+MAX_BATCH_SIZE = 250
+# Rough per-request token estimate used for budgeting (prompt + one image + JSON answer)
+PROMPT_TOKENS = 300
+IMAGE_TOKENS = 260
+OUTPUT_TOKENS = 450
+PRODUCT_FIELDS = ["artisanId", "story", "imageUrl", "imageVariantPaths"]
+
+
+class TokenBudget:
+    """Blocking tokens-per-minute bucket shared by all backfill workers."""
+
+    def __init__(self, tokens_per_minute: float):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self._tokens = tokens_per_minute
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+def estimate_tokens(transcript: str) -> int:
+    return PROMPT_TOKENS + IMAGE_TOKENS + OUTPUT_TOKENS + len(transcript) // 4
+
+
+def sampled(product_id: str, rate: float) -> bool:
+    """Deterministic sampling by id, so a rerun with the same rate picks the same products."""
+    if rate >= 1.0:
+        return True
+    return int(hashlib.sha1(product_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < rate
+
+
+def load_checkpoint(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {"lastId": None, "failed": [], "stats": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: Dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, path)
+
+
+def stream_products(after_id: Optional[str] = None, page_size: int = 500) -> Iterator:
+    """Streams `products` in document-id order, one page at a time, starting after `after_id`."""
+    collection = db.collection("products")
+    last_id = after_id
+    while True:
+        query = collection.select(PRODUCT_FIELDS).order_by(firestore.FieldPath.document_id()).limit(page_size)
+        if last_id:
+            query = query.where(firestore.FieldPath.document_id(), ">", collection.document(last_id))
+        page = list(query.stream())
+        yield from page
+        if len(page) < page_size:
+            return
+        last_id = page[-1].id
+
+
+def _image_source(data: Dict) -> Optional[str]:
+    # The medium JPEG rendition is plenty for the model and far smaller than the original
+    for path in data.get("imageVariantPaths") or []:
+        if path.endswith("_medium.jpg"):
+            return path
+    return storage_path_from_url(data.get("imageUrl"))
+
+
+class StoryBackfill:
+    """Regenerates `product_stories` for the catalog with bounded concurrency and a token budget.
+
+    Products are dispatched in id order; the checkpoint's `lastId` only advances past a
+    product once its story is committed (or it is recorded in `failed`), so a crashed run
+    resumes without skipping anything. Failed ids are retried first on the next run.
+    Each committed story queues its product in REINDEX_COLLECTION for the API server to
+    re-embed (this process never writes the server's index), and the discovery feed is
+    rebuilt once at the end.
+    """
+
+    def __init__(self, concurrency: int = 8, tokens_per_minute: float = 200_000, batch_size: int = 100,
+                 sample_rate: float = 1.0, limit: Optional[int] = None, dry_run: bool = False,
+                 checkpoint_path: str = CHECKPOINT_PATH):
+        self.concurrency = concurrency
+        self.budget = TokenBudget(tokens_per_minute)
+        self.tokens_per_minute = tokens_per_minute
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.sample_rate = sample_rate
+        self.limit = limit
+        self.dry_run = dry_run
+        self.checkpoint_path = checkpoint_path
+        self.stats = {"regenerated": 0, "skipped": 0, "failed": 0, "estimatedTokens": 0}
+        self._artisans: Dict[str, Dict] = {}
+        self._artisans_lock = threading.Lock()
+
+    def _artisan(self, artisan_id: str) -> Dict:
+        with self._artisans_lock:
+            cached = self._artisans.get(artisan_id)
+        if cached is None:
+            doc = db.collection("users").document(artisan_id).get(
+                field_paths=["name", "shopName", "location", "address"]
+            )
+            data = doc.to_dict() if doc.exists else {}
+            cached = {
+                "name": data.get("name"),
+                "shop_name": data.get("shopName"),
+                "location": data.get("location") or data.get("address")
+            }
+            with self._artisans_lock:
+                self._artisans[artisan_id] = cached
+        return cached
+
+    def _regenerate(self, doc) -> Optional[Dict]:
+        """Builds the new story document for one product (worker thread). None = skipped."""
+        data = doc.to_dict()
+        artisan_id, transcript, source = data.get("artisanId"), data.get("story"), _image_source(data)
+        if not (artisan_id and transcript and source):
+            return None
+        artisan = self._artisan(artisan_id)
+        if not all(artisan.values()):
+            return None
+
+        tokens = estimate_tokens(transcript)
+        if self.dry_run:
+            return {"estimatedTokens": tokens}
+        image = base64.b64encode(bucket.blob(source).download_as_bytes()).decode("utf-8")
+        self.budget.acquire(tokens)
+        # No hedged duplicates: every request must be paid for by the budget above
+        story = generate_story_from_details({
+            "audio_transcript": transcript,
+            "base64_images": [image],
+            **artisan
+        }, hedge=False)
+        if "error" in story:
+            raise ValueError(story["error"])
+        final_data = {
+            "user_id": artisan_id,
+            "product_id": doc.id,
+            **artisan,
+            "story": story,
+            "timestamp": datetime.datetime.utcnow().isoformat()
+        }
+        upload_story_copy(final_data)
+        return {"estimatedTokens": tokens, "final": final_data}
+
+    def _candidates(self, retry_ids: List[str], after_id: Optional[str]) -> Iterator:
+        """Yields (doc, advances_watermark): previously failed products first, then the stream."""
+        for product_id in retry_ids:
+            doc = db.collection("products").document(product_id).get(field_paths=PRODUCT_FIELDS)
+            if doc.exists:
+                yield doc, False
+        for doc in stream_products(after_id):
+            yield doc, True
+
+    def run(self) -> Dict:
+        checkpoint = load_checkpoint(self.checkpoint_path)
+        retry_ids, failed = checkpoint.get("failed", []), []
+        # Entries in dispatch order, [id, advances_watermark, state], state: running/pending/done
+        order: deque = deque()
+        batch: List[Dict] = []
+        ready = 0
+        dispatched = 0
+
+        def commit():
+            if batch and not self.dry_run:
+                writes = db.batch()
+                for final_data in batch:
+                    writes.set(story_ref(final_data["user_id"], final_data["product_id"]), final_data)
+                    writes.set(db.collection(REINDEX_COLLECTION).document(final_data["product_id"]),
+                               {"artisanId": final_data["user_id"], "queuedAt": final_data["timestamp"]})
+                writes.commit()
+            batch.clear()
+            for entry in order:
+                if entry[2] == "pending":
+                    entry[2] = "done"
+            while order and order[0][2] == "done":
+                product_id, advances, _ = order.popleft()
+                if advances:
+                    checkpoint["lastId"] = product_id
+            # Retries still in flight stay recorded as failed until they succeed
+            checkpoint["failed"] = failed + [e[0] for e in order if not e[1] and e[2] != "done"]
+            checkpoint["stats"] = self.stats
+            if not self.dry_run:
+                save_checkpoint(self.checkpoint_path, checkpoint)
+            logger.info(f"Story backfill progress: {self.stats} (last id {checkpoint['lastId']})")
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            in_flight = {}
+            candidates = self._candidates(retry_ids, checkpoint.get("lastId"))
+            exhausted = False
+            while in_flight or not exhausted:
+                # Keep a bounded window of work so the catalog is never held in memory
+                while not exhausted and len(in_flight) < self.concurrency * 2:
+                    next_item = next(candidates, None)
+                    if next_item is None or (self.limit is not None and dispatched >= self.limit):
+                        exhausted = True
+                        break
+                    doc, advances = next_item
+                    entry = [doc.id, advances, "running"]
+                    order.append(entry)
+                    if not sampled(doc.id, self.sample_rate):
+                        entry[2] = "done"
+                        continue
+                    dispatched += 1
+                    in_flight[pool.submit(self._regenerate, doc)] = entry
+                if not in_flight:
+                    continue
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = in_flight.pop(future)
+                    entry[2] = "done"
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error(f"Story backfill failed for {entry[0]}: {e!r}")
+                        failed.append(entry[0])
+                        self.stats["failed"] += 1
+                        if isinstance(e, LLMUnavailableError):
+                            # Upstream outage: let the circuit cool down before dispatching more
+                            time.sleep(e.retry_after)
+                        continue
+                    if result is None:
+                        self.stats["skipped"] += 1
+                        continue
+                    self.stats["estimatedTokens"] += result["estimatedTokens"]
+                    self.stats["regenerated"] += 1
+                    if "final" in result:
+                        batch.append(result["final"])
+                    entry[2] = "pending"
+                    ready += 1
+                if ready >= self.batch_size:
+                    commit()
+                    ready = 0
+            commit()
+
+        if not self.dry_run and self.stats["regenerated"]:
+            # One scan instead of a feed transaction per product; cards pick up the new stories
+            rebuild_feed()
+        if self.dry_run:
+            self.stats["estimatedMinutes"] = round(self.stats["estimatedTokens"] / self.tokens_per_minute, 1)
+        return self.stats
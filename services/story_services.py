@@ -6,26 +6,31 @@ import os
 import datetime
 import json
 import re
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 # Firebase & GCS
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud import storage
+from google.api_core.exceptions import NotFound, PreconditionFailed
 
 # LangChain
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage
 
+from services.llm_client import ResilientLLM
+from utils.profiling import profile_span
+
 # --- Initializations ---
 logger = logging.getLogger("storytelling_app")
 db = firestore.client()
 storage_client = storage.Client()
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 
-llm = ChatOpenAI(
-    model="google/gemini-flash-1.5",
+# Primary model with an optional fallback; see services/llm_client.py for deadlines and hedging
+llm = ResilientLLM(
+    primary=os.getenv("LLM_MODEL", "google/gemini-flash-1.5"),
+    fallback=os.getenv("LLM_FALLBACK_MODEL"),
     api_key=os.getenv("OPENROUTER_API_KEY"),
     base_url="https://openrouter.ai/api/v1",
     temperature=0.7,
@@ -46,9 +51,13 @@ def parse_json_from_llm(raw_text: str) -> Dict:
             return {"error": "Failed to parse JSON from LLM output", "raw_output": raw_text}
     return {"error": "No JSON object found in LLM output", "raw_output": raw_text}
 
+# Keys of the story JSON and the categories the model may choose from
+STORY_KEYS = ["Title", "Category", "Tagline", "ForWhom", "Material", "Method", "CulturalSignificance", "WhoMadeIt"]
+CATEGORIES = ["Pottery", "Painting", "Food", "Fabric and Clothing", "Glass Artefact", "Sculptures"]
+
 # --- Core Service Logic ---
-def generate_story_from_details(details: Dict) -> Dict:
-    """Generates a story by invoking the LLM with multimodal input."""
+def generate_story_from_details(details: Dict, hedge: bool = True) -> Dict:
+    """Generates a story by invoking the LLM with multimodal input (`hedge` as in ResilientLLM.invoke)."""
     try:
         audio_transcript = details["audio_transcript"]
         name = details["name"]
@@ -78,22 +87,89 @@ def generate_story_from_details(details: Dict) -> Dict:
         ("system", "You are an expert cultural product storyteller. Your task is to visually analyze product images and combine that with an artisan's description to generate a compelling story. The final output must be a single, clean JSON object."),
         user_prompt_message
     ])
-    chain = prompt | llm
-    response = chain.invoke({})
+    with profile_span("llm"):
+        response = llm.invoke(prompt.format_messages(), hedge=hedge)
     return parse_json_from_llm(response.content)
 
 
+def regenerate_story_fields(story: Dict, fields: List[str], instructions: Optional[str] = None) -> Dict:
+    """Rewrites only `fields` of an existing story with a short text-only prompt.
+
+    The rest of the story is sent as context so the new values stay consistent with it;
+    no images or transcript are re-sent. Returns {field: new value} or {"error": ...}.
+    """
+    context = {k: v for k, v in story.items() if k in STORY_KEYS and k not in fields}
+    rules = f" Category must be one of: {', '.join(CATEGORIES)}." if "Category" in fields else ""
+    messages = [
+        ("system", "You are an expert cultural product storyteller. Reply with a single, clean JSON object."),
+        ("human",
+         f"Existing product story: {json.dumps(context, ensure_ascii=False)}\n"
+         f"Write new values for {json.dumps(fields)} that fit the story above.{rules}"
+         + (f" Artisan's request: {instructions}" if instructions else "")
+         + f"\nReturn a JSON object with exactly these keys: {json.dumps(fields)}.")
+    ]
+    with profile_span("llm"):
+        response = llm.invoke(messages)
+    result = parse_json_from_llm(response.content)
+    if "error" in result:
+        return result
+    missing = [f for f in fields if not result.get(f)]
+    if missing:
+        return {"error": f"LLM output is missing {missing}", "raw_output": response.content}
+    return {f: result[f] for f in fields}
+
+
+def story_ref(user_id: str, product_id: str):
+    return db.collection("product_stories").document(user_id).collection("products").document(product_id)
+
+
+def story_blob(user_id: str, product_id: str):
+    return storage_client.bucket(BUCKET_NAME).blob(f"stories/{user_id}_{product_id}.json")
+
+
+def upload_story_copy(final_data: Dict):
+    """Writes the GCS copy of a story document."""
+    blob = story_blob(final_data["user_id"], final_data["product_id"])
+    blob.upload_from_string(json.dumps(final_data, indent=2), content_type="application/json")
+
+
 def save_story_to_gcs_and_firestore(final_data: Dict):
     """Saves the final story data to both GCS and Firestore."""
     user_id = final_data["user_id"]
     product_id = final_data["product_id"]
 
     # Save to Firestore
-    product_ref = db.collection("product_stories").document(user_id).collection("products").document(product_id)
-    product_ref.set(final_data, merge=True)
+    story_ref(user_id, product_id).set(final_data, merge=True)
 
     # Save to GCS
-    filename = f"{user_id}_{product_id}.json"
-    blob = storage_client.bucket(BUCKET_NAME).blob(f"stories/{filename}")
-    blob.upload_from_string(json.dumps(final_data, indent=2), content_type="application/json")
-    logger.info(f"Story saved successfully for product {product_id}")
\ No newline at end of file
+    upload_story_copy(final_data)
+    logger.info(f"Story saved successfully for product {product_id}")
+
+
+def patch_story_fields(user_id: str, product_id: str, updates: Dict, timestamp: str):
+    """Writes regenerated story keys to Firestore and the GCS copy without touching other keys."""
+    story_ref(user_id, product_id).update({
+        **{f"story.{key}": value for key, value in updates.items()},
+        "timestamp": timestamp
+    })
+
+    # Read-modify-write of the GCS copy, guarded by its generation against concurrent patches
+    blob = story_blob(user_id, product_id)
+    for attempt in range(3):
+        try:
+            blob.reload()
+            data = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+            data.setdefault("story", {}).update(updates)
+            data["timestamp"] = timestamp
+            blob.upload_from_string(json.dumps(data, indent=2), content_type="application/json",
+                                    if_generation_match=blob.generation)
+            break
+        except PreconditionFailed:
+            logger.warning(f"Story copy for {product_id} changed during patch, retrying")
+        except NotFound:
+            # No GCS copy yet: write the whole document from Firestore
+            upload_story_copy(story_ref(user_id, product_id).get().to_dict())
+            break
+    else:
+        logger.error(f"Gave up patching the GCS story copy for {product_id}; Firestore is up to date")
+    logger.info(f"Story fields {list(updates)} patched for product {product_id}")
@@ -0,0 +1,211 @@
+# services/streaming_transcriber.py
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import wave
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from services.transcribe_audio import transcribe_segments, SAMPLE_RATE
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+STREAM_STEP_SECONDS = float(os.getenv("STREAM_STEP_SECONDS", "1.0"))
+STREAM_WINDOW_SECONDS = float(os.getenv("STREAM_WINDOW_SECONDS", "20"))
+# Segments ending this close to the live edge may still change, so they stay partial
+STREAM_STABILITY_MARGIN_SECONDS = 1.5
+MAX_STREAM_SECONDS = int(os.getenv("MAX_STREAM_SECONDS", "1800"))
+# Concurrent streaming sessions allowed per uid (or IP for anonymous callers) in this process
+MAX_STREAMS_PER_CLIENT = int(os.getenv("MAX_STREAMS_PER_CLIENT", "1"))
+# Streamed audio is charged to the rate limiter once per this many seconds received
+STREAM_BILLING_SECONDS = 60.0
+PROMPT_CHARS = 200
+
+
+class StreamingTranscriber:
+    """Incremental Whisper decoding over a sliding window of 16kHz mono PCM16 audio.
+
+    Audio before `committed` has been finalized. Each `step()` decodes only the
+    uncommitted window; segments that end safely behind the live edge are finalized and
+    the window slides forward past them, so per-step cost is bounded by the window
+    length rather than the recording length. Only the uncommitted PCM16 is kept in
+    memory; finalized audio is spooled to a temporary file for `write_wav`.
+    """
+
+    def __init__(self, lang: Optional[str] = None, task: str = "transcribe"):
+        self.lang = lang
+        self.task = task
+        # PCM16 chunks from `_committed` onwards
+        self._chunks: List[np.ndarray] = []
+        self._spool = tempfile.TemporaryFile()
+        self._samples = 0
+        self._committed = 0
+        self._decoded_at = 0
+        self.finals: List[Dict] = []
+
+    @property
+    def duration(self) -> float:
+        return self._samples / SAMPLE_RATE
+
+    @property
+    def text(self) -> str:
+        return " ".join(f["text"] for f in self.finals).strip()
+
+    def feed(self, pcm16: bytes):
+        if len(pcm16) % 2:
+            pcm16 = pcm16[:-1]
+        samples = np.frombuffer(pcm16, dtype="<i2")
+        self._chunks.append(samples)
+        self._samples += len(samples)
+        if self.duration > MAX_STREAM_SECONDS:
+            raise ValueError(f"Recording exceeds {MAX_STREAM_SECONDS}s")
+
+    def ready(self) -> bool:
+        return self._samples - self._decoded_at >= STREAM_STEP_SECONDS * SAMPLE_RATE
+
+    def _pending(self) -> np.ndarray:
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        return self._chunks[0] if self._chunks else np.zeros(0, dtype="<i2")
+
+    def _commit(self, samples: int):
+        """Moves the first `samples` uncommitted samples to the spool file."""
+        pending = self._pending()
+        samples = min(samples, len(pending))
+        self._spool.write(pending[:samples].tobytes())
+        # Copied so the finalized part of the buffer can be freed
+        self._chunks = [pending[samples:].copy()]
+        self._committed += samples
+
+    def _prompt(self) -> Optional[str]:
+        return self.text[-PROMPT_CHARS:] or None
+
+    def step(self, final: bool = False) -> Tuple[List[Dict], str]:
+        """Decodes the uncommitted window (blocking). Returns (newly finalized segments, partial text)."""
+        pending = self._pending()
+        self._decoded_at = self._samples
+        window = pending.astype(np.float32) / 32768.0
+        if len(window) < SAMPLE_RATE // 10:
+            return [], ""
+
+        segments = transcribe_segments(window, self.lang, self.task, initial_prompt=self._prompt())
+        window_seconds = len(window) / SAMPLE_RATE
+        if final:
+            stable = segments
+        else:
+            horizon = window_seconds - STREAM_STABILITY_MARGIN_SECONDS
+            stable = [s for s in segments if s.end <= horizon]
+            # The newest segment always stays partial; it may end mid-sentence
+            if len(stable) == len(segments):
+                stable = stable[:-1]
+            if not stable and window_seconds > STREAM_WINDOW_SECONDS and segments:
+                # Window is full without a stable boundary; force the oldest segment out
+                stable = segments[:1]
+
+        offset = self._committed / SAMPLE_RATE
+        new_finals = [
+            {"text": s.text.strip(), "start": round(offset + s.start, 2), "end": round(offset + s.end, 2)}
+            for s in stable if s.text.strip()
+        ]
+        self.finals.extend(new_finals)
+        if final or (not segments and window_seconds > STREAM_WINDOW_SECONDS):
+            # Finished, or a full window of silence: nothing left worth re-decoding
+            self._commit(len(pending))
+        elif stable:
+            self._commit(int(stable[-1].end * SAMPLE_RATE))
+        partial = " ".join(s.text.strip() for s in segments[len(stable):]).strip()
+        return new_finals, partial
+
+    def write_wav(self, path: str):
+        """Writes the whole recording: the spooled finalized audio, then the rest."""
+        with wave.open(path, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLE_RATE)
+            self._spool.seek(0)
+            shutil.copyfileobj(self._spool, _FrameWriter(wav))
+            self._spool.seek(0, os.SEEK_END)
+            wav.writeframes(self._pending().tobytes())
+
+    def close(self):
+        self._spool.close()
+
+
+class _FrameWriter:
+    """File-like adapter so shutil.copyfileobj can stream into a wave writer."""
+
+    def __init__(self, wav):
+        self.wav = wav
+
+    def write(self, data: bytes):
+        self.wav.writeframes(data)
+
+
+_active_streams: Counter = Counter()
+
+
+def acquire_stream_slot(client: str) -> bool:
+    """Caps concurrent streaming sessions per client key; pair with release_stream_slot."""
+    if _active_streams[client] >= MAX_STREAMS_PER_CLIENT:
+        return False
+    _active_streams[client] += 1
+    return True
+
+
+def release_stream_slot(client: str):
+    _active_streams[client] -= 1
+    if _active_streams[client] <= 0:
+        del _active_streams[client]
+
+
+async def run_stream_session(websocket, transcriber: StreamingTranscriber,
+                             charge: Optional[Callable[[], Awaitable[None]]] = None) -> bool:
+    """Feeds binary PCM16 frames into `transcriber` and pushes partial/final segments back.
+
+    `charge` is awaited once per STREAM_BILLING_SECONDS of audio received so long sessions
+    keep paying the rate limiter (and renewing their slot); if it raises HTTPException the
+    session is closed.
+    Returns True when the client sent {"type": "stop"} (all audio finalized), False if it
+    disconnected first or was cut off.
+    """
+    billed_seconds = 0.0
+    async def send_results(finals: List[Dict], partial: str):
+        for segment in finals:
+            await websocket.send_json({"type": "final", **segment})
+        if partial:
+            await websocket.send_json({"type": "partial", "text": partial})
+
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return False
+        if message.get("bytes"):
+            transcriber.feed(message["bytes"])
+            if charge and transcriber.duration >= billed_seconds + STREAM_BILLING_SECONDS:
+                billed_seconds += STREAM_BILLING_SECONDS
+                try:
+                    await charge()
+                except HTTPException as e:
+                    await websocket.send_json({"type": "error", "detail": e.detail})
+                    await websocket.close(code=1013)
+                    return False
+            if transcriber.ready():
+                await send_results(*await run_in_threadpool(transcriber.step))
+        elif message.get("text"):
+            try:
+                command = json.loads(message["text"])
+            except json.JSONDecodeError:
+                await websocket.send_json({"type": "error", "detail": "Expected JSON control message"})
+                continue
+            if command.get("type") == "stop":
+                finals, _ = await run_in_threadpool(transcriber.step, True)
+                await send_results(finals, "")
+                return True
@@ -1,29 +1,265 @@
 from faster_whisper import WhisperModel
-from typing import Optional
+from faster_whisper.audio import decode_audio
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import contextvars
+from typing import Dict, List, Optional, Tuple
 import logging
+import os
+import re
+import threading
+
+import numpy as np
+
+from utils.profiling import profile_span
 
 logger = logging.getLogger(__name__)
 
-# Global model loaded once at startup
-model = None
+# --- Configuration ---
+WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "small")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+# Per-language model choice, e.g. "en=small.en,ta=medium,hi=medium"; anything unlisted
+# (including auto-detect) uses WHISPER_MODEL_SIZE
+WHISPER_MODELS = os.getenv("WHISPER_MODELS", "en=small.en")
+# Upper bound on models held in memory at once; least recently used is unloaded first
+MAX_RESIDENT_MODELS = int(os.getenv("WHISPER_MAX_RESIDENT_MODELS", "2"))
+# Parallel decodes per model instance; CPU threads are split between them
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", str(max(1, min(4, (os.cpu_count() or 1) // 2)))))
+
+SAMPLE_RATE = 16000
+# Recordings longer than this are split at silences and transcribed in parallel
+LONG_AUDIO_THRESHOLD_SECONDS = float(os.getenv("LONG_AUDIO_THRESHOLD_SECONDS", "90"))
+CHUNK_TARGET_SECONDS = float(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "45"))
+CHUNK_SEARCH_SECONDS = 8.0   # how far around each target boundary to look for a silence
+CHUNK_OVERLAP_SECONDS = 1.0  # decoding context shared with each neighbour
+ENERGY_FRAME_SECONDS = 0.03
+
+
+def _parse_model_map(raw: str) -> Dict[str, str]:
+    mapping = {}
+    for item in raw.split(","):
+        if "=" in item:
+            code, name = item.split("=", 1)
+            mapping[code.strip().lower()] = name.strip()
+    return mapping
+
+
+_language_models = _parse_model_map(WHISPER_MODELS)
+
+# Models loaded on demand, most recently used last
+_models: "OrderedDict[str, WhisperModel]" = OrderedDict()
+# Guards _models only; never held while a model loads or downloads
+_model_lock = threading.Lock()
+# One lock per model name so concurrent requests for a cold model load it once
+_loaders: Dict[str, threading.Lock] = {}
+
+
+def to_whisper_language(lang: Optional[str]) -> Optional[str]:
+    """Maps a locale code such as "ta-IN" to Whisper's bare language code ("ta")."""
+    if not lang or lang == "auto":
+        return None
+    return re.split(r"[-_]", lang.strip())[0].lower() or None
+
+
+def model_name_for(lang: Optional[str]) -> str:
+    return _language_models.get(to_whisper_language(lang) or "", WHISPER_MODEL_SIZE)
+
+
+def _evict_lru(keep: int):
+    # Caller holds _model_lock. In-flight decodes keep their own reference; memory is freed when they finish
+    while len(_models) > keep:
+        evicted, _ = _models.popitem(last=False)
+        logger.info(f"Unloaded Whisper model '{evicted}'")
+
+
+def _load(name: str) -> WhisperModel:
+    """Returns a resident model or loads it; only loaders of the same name wait on each other."""
+    with _model_lock:
+        if name in _models:
+            _models.move_to_end(name)
+            return _models[name]
+        loader = _loaders.setdefault(name, threading.Lock())
+
+    with loader:
+        with _model_lock:
+            if name in _models:  # loaded by the thread we waited for
+                _models.move_to_end(name)
+                return _models[name]
+            # Make room first so the resident set never exceeds the cap by a full model
+            _evict_lru(MAX_RESIDENT_MODELS - 1)
+        cpu_threads = max(1, (os.cpu_count() or 1) // TRANSCRIBE_WORKERS)
+        model = WhisperModel(
+            name,
+            device="cpu",
+            compute_type=WHISPER_COMPUTE_TYPE,
+            cpu_threads=cpu_threads,
+            num_workers=TRANSCRIBE_WORKERS
+        )
+        with _model_lock:
+            _models[name] = model
+            _evict_lru(MAX_RESIDENT_MODELS)
+        logger.info(f"Loaded Whisper model '{name}' ({TRANSCRIBE_WORKERS} workers x {cpu_threads} threads)")
+        return model
+
+
+def load_model(lang: Optional[str] = None) -> WhisperModel:
+    """Returns the model configured for `lang`, loading it (and evicting the LRU model) if needed."""
+    return _load(model_name_for(lang))
+
+
+def translation_is_identity(lang: Optional[str]) -> bool:
+    """True when a "translate" pass would just re-transcribe English audio."""
+    return to_whisper_language(lang) == "en"
 
 
-def transcribe_audio(audio_file_path: str, lang: Optional[str] = None, task: str = "transcribe") -> Optional[str]:
-    global model
-     # Fallback load if not called at startup
-    
-    try:
+def _route(lang: Optional[str], task: str) -> Tuple[WhisperModel, Optional[str], str]:
+    """Picks the model for `lang` and adapts language/task to what that model supports."""
+    name = model_name_for(lang)
+    code = to_whisper_language(lang)
+    if name.endswith(".en"):
+        # English-only checkpoints can't translate, and for English audio there is nothing to translate
+        code, task = "en", "transcribe"
+    return _load(name), code, task
+
+
+def transcribe_audio(
+    audio_file_path: str,
+    lang: Optional[str] = None,
+    task: str = "transcribe",
+    long_audio: Optional[bool] = None
+) -> Optional[str]:
+    """Transcribes (or translates) an audio file; returns None on failure.
+
+    `lang` may be a locale ("ta-IN") or a bare code ("ta"). `long_audio=None` picks the
+    chunked parallel mode automatically for recordings longer than
+    LONG_AUDIO_THRESHOLD_SECONDS.
+    """
+    with profile_span("transcription"):
+        try:
+            model, code, task = _route(lang, task)
+            audio = decode_audio(audio_file_path, sampling_rate=SAMPLE_RATE)
+            if long_audio is None:
+                long_audio = len(audio) > LONG_AUDIO_THRESHOLD_SECONDS * SAMPLE_RATE
+            if long_audio:
+                return _transcribe_chunked(model, audio, code, task)
+            segments, _ = model.transcribe(
+                audio,
+                language=code,
+                task=task,
+                beam_size=5,
+                condition_on_previous_text=False
+            )
+            return " ".join(segment.text for segment in segments).strip()
+        except ValueError as e:
+            logger.error(f"Audio format error: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Transcription error: {e}")
+            return None
+
+
+def transcribe_segments(audio: np.ndarray, lang: Optional[str] = None, task: str = "transcribe", **options) -> list:
+    """Decodes an in-memory 16kHz float32 array and returns the materialized segments."""
+    model, code, task = _route(lang, task)
+    with profile_span("transcription"):
         segments, _ = model.transcribe(
-            audio_file_path, 
-            language=lang, 
-            task=task, 
-            beam_size=5,
-            condition_on_previous_text=False  
+            audio,
+            language=code,
+            task=task,
+            beam_size=options.pop("beam_size", 5),
+            condition_on_previous_text=False,
+            **options
         )
-        return " ".join(segment.text for segment in segments).strip()
-    except ValueError as e:
-        logger.error(f"Audio format error: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"Transcription error: {e}")
-        return None
\ No newline at end of file
+        return list(segments)
+
+
+# --- Long-audio mode ---
+def _silence_cut_points(audio: np.ndarray) -> List[int]:
+    """Sample offsets at which to split: the quietest frame near every CHUNK_TARGET_SECONDS."""
+    frame = int(ENERGY_FRAME_SECONDS * SAMPLE_RATE)
+    n_frames = len(audio) // frame
+    energy = np.sqrt(np.mean(audio[: n_frames * frame].reshape(n_frames, frame) ** 2, axis=1))
+    # Smooth so a single quiet frame inside a word doesn't win over a real pause
+    energy = np.convolve(energy, np.ones(5) / 5, mode="same")
+
+    target = int(CHUNK_TARGET_SECONDS / ENERGY_FRAME_SECONDS)
+    search = int(CHUNK_SEARCH_SECONDS / ENERGY_FRAME_SECONDS)
+    cuts = []
+    position = 0
+    while n_frames - position > target + search:
+        lo, hi = position + target - search, position + target + search
+        best = lo + int(np.argmin(energy[lo:hi]))
+        cuts.append(best * frame)
+        position = best
+    return cuts
+
+
+def _transcribe_chunk(model: WhisperModel, audio: np.ndarray, start: int, end: int, keep_from: int, keep_to: int,
+                      lang: Optional[str], task: str) -> List[Tuple[float, str]]:
+    """Decodes audio[start:end] and keeps the words whose midpoint falls in [keep_from, keep_to)."""
+    offset = start / SAMPLE_RATE
+    lo, hi = keep_from / SAMPLE_RATE, keep_to / SAMPLE_RATE
+    segments, _ = model.transcribe(
+        audio[start:end],
+        language=lang,
+        task=task,
+        beam_size=5,
+        condition_on_previous_text=False,
+        word_timestamps=True
+    )
+    kept = []
+    for segment in segments:
+        units = segment.words or [segment]
+        for unit in units:
+            text = getattr(unit, "word", None) or unit.text
+            midpoint = offset + (unit.start + unit.end) / 2
+            if lo <= midpoint < hi:
+                kept.append((offset + unit.start, text))
+    return kept
+
+
+def _profiled_chunk(*args) -> List[Tuple[float, str]]:
+    with profile_span("transcription_chunk"):
+        return _transcribe_chunk(*args)
+
+
+def _normalize_word(word: str) -> str:
+    return re.sub(r"[^\w]", "", word.lower())
+
+
+def _dedupe_boundary(previous: List[str], following: List[str], max_overlap: int = 6) -> List[str]:
+    """Drops leading words of `following` that repeat the trailing words of `previous`.
+
+    Timestamp filtering removes most overlap; this catches words whose timestamps
+    drifted across the cut in both chunks.
+    """
+    for size in range(min(max_overlap, len(previous), len(following)), 0, -1):
+        tail = [_normalize_word(w) for w in previous[-size:]]
+        head = [_normalize_word(w) for w in following[:size]]
+        if tail == head and any(tail):
+            return following[size:]
+    return following
+
+
+def _transcribe_chunked(model: WhisperModel, audio: np.ndarray, lang: Optional[str], task: str) -> str:
+    cuts = _silence_cut_points(audio)
+    bounds = [0, *cuts, len(audio)]
+    overlap = int(CHUNK_OVERLAP_SECONDS * SAMPLE_RATE)
+    jobs = [
+        (max(0, bounds[i] - overlap), min(len(audio), bounds[i + 1] + overlap), bounds[i], bounds[i + 1])
+        for i in range(len(bounds) - 1)
+    ]
+    logger.info(f"Long-audio mode: {len(audio) / SAMPLE_RATE:.0f}s in {len(jobs)} chunks on {TRANSCRIBE_WORKERS} workers")
+
+    def run(job, context):
+        # Each chunk runs in a copy of the caller's context so request profiling follows it
+        return context.run(_profiled_chunk, model, audio, *job, lang, task)
+
+    with ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS) as pool:
+        results = list(pool.map(run, jobs, [contextvars.copy_context() for _ in jobs]))
+
+    words: List[str] = []
+    for chunk in results:
+        chunk_words = [text.strip() for _, text in sorted(chunk) if text.strip()]
+        words.extend(_dedupe_boundary(words, chunk_words))
+    return " ".join(words).strip()
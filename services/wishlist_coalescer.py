@@ -0,0 +1,117 @@
+# services/wishlist_coalescer.py
+
+import asyncio
+import itertools
+import logging
+import os
+from typing import Dict, List
+
+from fastapi.concurrency import run_in_threadpool
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+
+# How long adds/removes for one user are buffered before a single write
+COALESCE_WINDOW_SECONDS = float(os.getenv("WISHLIST_COALESCE_MS", "500")) / 1000.0
+# Failed flushes back off exponentially from the window; ops are dropped after this many
+FLUSH_MAX_ATTEMPTS = int(os.getenv("WISHLIST_FLUSH_MAX_ATTEMPTS", "5"))
+FLUSH_MAX_BACKOFF_SECONDS = 30.0
+
+
+def _merge(wishlist: List[str], ops: Dict[str, str]) -> List[str]:
+    """Applies netted add/remove ops to a wishlist, keeping existing order."""
+    result = [p for p in wishlist if ops.get(p) != "remove"]
+    present = set(result)
+    result.extend(p for p, action in ops.items() if action == "add" and p not in present)
+    return result
+
+
+@firestore.transactional
+def _apply_in_transaction(transaction, user_ref, ops: Dict[str, str]):
+    snapshot = user_ref.get(field_paths=["wishlist"], transaction=transaction)
+    wishlist = (snapshot.to_dict() or {}).get("wishlist", []) if snapshot.exists else []
+    transaction.update(user_ref, {"wishlist": _merge(wishlist, ops)})
+
+
+class WishlistCoalescer:
+    """Buffers wishlist adds/removes per user and commits them as one write per window.
+
+    Ops for the same product net out (last action wins), so a burst of heart taps on a
+    feed becomes a single document write. Pending ops are overlaid on reads from this
+    process, giving read-your-writes before the flush lands. A failing user is retried
+    with exponential backoff and their ops are dropped after FLUSH_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, window: float = COALESCE_WINDOW_SECONDS):
+        self.window = window
+        self._pending: Dict[str, Dict[str, str]] = {}
+        # Ops currently being committed, per flush; still overlaid so reads never miss them
+        self._inflight: Dict[str, Dict[int, Dict[str, str]]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        # Consecutive failed flushes per user
+        self._failures: Dict[str, int] = {}
+        self._flush_ids = itertools.count()
+
+    def submit(self, uid: str, product_id: str, action: str):
+        self._pending.setdefault(uid, {})[product_id] = action
+        if uid not in self._timers:
+            self._timers[uid] = asyncio.create_task(self._flush_later(uid, self.window))
+
+    def overlay(self, uid: str, wishlist: List[str]) -> List[str]:
+        """Applies this user's unflushed ops to a wishlist read from Firestore."""
+        # Flush ids increase, so in-flight ops apply in submission order before pending ones
+        for _, ops in sorted(self._inflight.get(uid, {}).items()):
+            wishlist = _merge(wishlist, ops)
+        if self._pending.get(uid):
+            wishlist = _merge(wishlist, self._pending[uid])
+        return wishlist
+
+    async def _flush_later(self, uid: str, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._timers.pop(uid, None)
+        await self.flush(uid)
+
+    async def flush(self, uid: str):
+        ops = self._pending.pop(uid, None)
+        if not ops:
+            return
+        flush_id = next(self._flush_ids)
+        self._inflight.setdefault(uid, {})[flush_id] = ops
+        try:
+            await run_in_threadpool(
+                _apply_in_transaction, db.transaction(), db.collection('users').document(uid), ops
+            )
+            self._failures.pop(uid, None)
+        except Exception as e:
+            failures = self._failures.get(uid, 0) + 1
+            if failures >= FLUSH_MAX_ATTEMPTS:
+                logger.error(f"Wishlist flush failed for {uid} {failures} times, dropping {ops}: {e}")
+                self._failures.pop(uid, None)
+                return
+            logger.warning(f"Wishlist flush failed for {uid} (attempt {failures}): {e}")
+            self._failures[uid] = failures
+            # Put back ops that weren't superseded meanwhile and retry after a backoff
+            pending = self._pending.setdefault(uid, {})
+            for product_id, action in ops.items():
+                pending.setdefault(product_id, action)
+            if uid not in self._timers:
+                delay = min(FLUSH_MAX_BACKOFF_SECONDS, self.window * 2 ** failures)
+                self._timers[uid] = asyncio.create_task(self._flush_later(uid, delay))
+        finally:
+            inflight = self._inflight.get(uid, {})
+            inflight.pop(flush_id, None)
+            if not inflight:
+                self._inflight.pop(uid, None)
+
+    async def flush_all(self):
+        """Cancels pending timers and flushes every buffered user (used on shutdown)."""
+        for task in list(self._timers.values()):
+            task.cancel()
+        self._timers.clear()
+        await asyncio.gather(*(self.flush(uid) for uid in list(self._pending)), return_exceptions=True)
+
+
+wishlist_coalescer = WishlistCoalescer()
@@ -1,6 +1,7 @@
-from fastapi import HTTPException, Header, Depends
+from fastapi import HTTPException, Header, Depends, Query, WebSocket
 from firebase_admin import auth, firestore
 from utils.firebase import get_db
+from utils.profiling import is_admin_token
 import logging
 
 logger = logging.getLogger(__name__)
@@ -38,4 +39,34 @@ async def get_current_buyer(
         return user_doc.to_dict(), uid
     except Exception as e:
         logger.error(f"Authentication error: {e}")
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+
+async def get_ws_artisan(
+    websocket: WebSocket,
+    token: str = Query(None),
+    db: firestore.client = Depends(get_db)
+):
+    """WebSocket variant of get_current_artisan: browsers cannot set headers on a WebSocket,
+    so the ID token comes from `?token=`. Returns None instead of raising; the route closes."""
+    if not token:
+        return None
+    try:
+        decoded_token = auth.verify_id_token(token)
+        uid = decoded_token['uid']
+        user_doc = db.collection('users').document(uid).get()
+        if not user_doc.exists or user_doc.to_dict().get('role') != 'artisan':
+            return None
+        return user_doc.to_dict(), uid
+    except Exception as e:
+        logger.error(f"WebSocket authentication error: {e}")
+        return None
+
+async def get_current_admin(token: str = Depends(get_token)):
+    try:
+        decoded_token = auth.verify_id_token(token)
+    except Exception as e:
+        logger.error(f"Authentication error: {e}")
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    if not is_admin_token(decoded_token):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return decoded_token['uid']
@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+
+logger = logging.getLogger(__name__)
+db = firestore.client()
+
+IDEMPOTENCY_COLLECTION = "idempotency_keys"
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+# An in-flight claim older than this is assumed to belong to a crashed worker
+IN_FLIGHT_TIMEOUT_SECONDS = int(os.getenv("IDEMPOTENCY_IN_FLIGHT_TIMEOUT", "600"))
+POLL_INTERVAL_SECONDS = 0.5
+MAX_KEY_LENGTH = 255
+
+
+class _Entry:
+    def __init__(self, fingerprint: Optional[str]):
+        self.fingerprint = fingerprint
+        self.done = asyncio.Event()
+        self.response: Optional[Dict] = None
+        self.expires_at = time.monotonic() + IN_FLIGHT_TIMEOUT_SECONDS
+
+
+class Claim:
+    """Result of `begin()`: either a stored `response` to replay, or ownership of the work.
+
+    The owner must call `complete(response)` on success; `abandon()` (safe to call after
+    `complete`) releases the key so a retry can run the work again.
+    """
+
+    def __init__(self, store: "IdempotencyStore", doc_id: Optional[str], response: Optional[Dict] = None):
+        self._store = store
+        self._doc_id = doc_id
+        self.response = response
+        self._finished = response is not None or doc_id is None
+
+    @property
+    def replay(self) -> bool:
+        return self.response is not None
+
+    async def complete(self, response: Dict):
+        if self._finished:
+            return
+        self._finished = True
+        await self._store._complete(self._doc_id, response)
+
+    async def abandon(self):
+        if self._finished:
+            return
+        self._finished = True
+        await self._store._abandon(self._doc_id)
+
+
+class IdempotencyStore:
+    """Idempotency-Key bookkeeping: in-process entries for same-worker duplicates, mirrored to
+    Firestore so duplicates landing on another worker (or after a restart) see the same state."""
+
+    def __init__(self):
+        self._entries: Dict[str, _Entry] = {}
+
+    @staticmethod
+    def _doc_id(scope: str, key: str) -> str:
+        return hashlib.sha256(f"{scope}:{key}".encode("utf-8")).hexdigest()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for doc_id in [d for d, e in self._entries.items() if e.expires_at < now]:
+            del self._entries[doc_id]
+
+    async def begin(self, scope: str, key: Optional[str], fingerprint: Optional[str] = None) -> Claim:
+        if not key:
+            return Claim(self, None)
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"Idempotency-Key longer than {MAX_KEY_LENGTH} characters")
+        doc_id = self._doc_id(scope, key)
+        self._evict_expired()
+
+        while True:
+            entry = self._entries.get(doc_id)
+            if entry is None:
+                break
+            self._check_fingerprint(entry.fingerprint, fingerprint)
+            if entry.response is not None:
+                return Claim(self, doc_id, entry.response)
+            # Same-worker duplicate: wait for the original computation
+            await entry.done.wait()
+            if entry.response is not None:
+                return Claim(self, doc_id, entry.response)
+            # Original failed and released the key; loop to claim it ourselves
+
+        entry = _Entry(fingerprint)
+        self._entries[doc_id] = entry
+        try:
+            response = await self._claim_remote(doc_id, fingerprint)
+        except BaseException:
+            self._entries.pop(doc_id, None)
+            entry.done.set()
+            raise
+        if response is not None:
+            entry.response = response
+            entry.expires_at = time.monotonic() + IDEMPOTENCY_TTL_SECONDS
+            entry.done.set()
+            return Claim(self, doc_id, response)
+        return Claim(self, doc_id)
+
+    @staticmethod
+    def _check_fingerprint(stored: Optional[str], given: Optional[str]):
+        if stored and given and stored != given:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+    async def _claim_remote(self, doc_id: str, fingerprint: Optional[str]) -> Optional[Dict]:
+        """Creates the in-flight marker in Firestore, or waits on another worker's claim.
+
+        Returns a stored response to replay, or None once this worker owns the key.
+        """
+        doc_ref = db.collection(IDEMPOTENCY_COLLECTION).document(doc_id)
+        while True:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            try:
+                await run_in_threadpool(doc_ref.create, {
+                    "state": "in_flight",
+                    "fingerprint": fingerprint,
+                    "startedAt": now,
+                    "expiresAt": now + datetime.timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+                })
+                return None
+            except AlreadyExists:
+                pass
+            snapshot = await run_in_threadpool(doc_ref.get)
+            if not snapshot.exists:
+                continue
+            data = snapshot.to_dict()
+            self._check_fingerprint(data.get("fingerprint"), fingerprint)
+            if data.get("expiresAt") and data["expiresAt"] < now:
+                await run_in_threadpool(doc_ref.delete)
+                continue
+            if data.get("state") == "done":
+                return data.get("response")
+            if data.get("startedAt") and (now - data["startedAt"]).total_seconds() > IN_FLIGHT_TIMEOUT_SECONDS:
+                logger.warning(f"Reclaiming stale idempotency claim {doc_id}")
+                await run_in_threadpool(doc_ref.delete)
+                continue
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    async def _complete(self, doc_id: str, response: Dict):
+        entry = self._entries.get(doc_id)
+        if entry:
+            entry.response = response
+            entry.expires_at = time.monotonic() + IDEMPOTENCY_TTL_SECONDS
+            entry.done.set()
+        try:
+            await run_in_threadpool(
+                db.collection(IDEMPOTENCY_COLLECTION).document(doc_id).update,
+                {"state": "done", "response": response}
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist idempotent response {doc_id}: {e}")
+
+    async def _abandon(self, doc_id: str):
+        entry = self._entries.pop(doc_id, None)
+        if entry:
+            entry.done.set()
+        try:
+            await run_in_threadpool(db.collection(IDEMPOTENCY_COLLECTION).document(doc_id).delete)
+        except Exception as e:
+            logger.error(f"Failed to release idempotency key {doc_id}: {e}")
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,262 @@
+import contextvars
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from firebase_admin import auth
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # fraction of requests, 0 = off
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000.0
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+PROFILE_HEADER = "x-profile"
+ADMIN_UIDS = {u.strip() for u in os.getenv("ADMIN_UIDS", "").split(",") if u.strip()}
+MAX_STACK_DEPTH = 64
+
+
+def is_admin_token(decoded_token: Dict) -> bool:
+    """Admins carry the `admin` custom claim or are listed in ADMIN_UIDS."""
+    return bool(decoded_token.get("admin")) or decoded_token.get("uid") in ADMIN_UIDS
+
+
+class RequestProfile:
+    """Samples and spans collected for one request."""
+
+    def __init__(self, method: str, path: str, loop_thread: int):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+        self.status: Optional[int] = None
+        self.stacks: Counter = Counter()
+        self.spans: List[Dict] = []
+        # Threads sampled for this request: the event loop plus any thread inside a span
+        self._threads = {loop_thread: "event-loop"}
+        self._lock = threading.Lock()
+        # Set by finish(); late samples/spans from the sampler or worker threads are dropped
+        self._finished = False
+
+    def enter_thread(self, name: str):
+        with self._lock:
+            self._threads[threading.get_ident()] = name
+
+    def leave_thread(self):
+        with self._lock:
+            if len(self._threads) > 1:
+                self._threads.pop(threading.get_ident(), None)
+
+    def threads(self) -> Dict[int, str]:
+        with self._lock:
+            return dict(self._threads)
+
+    def add_sample(self, stack: str):
+        with self._lock:
+            if not self._finished:
+                self.stacks[stack] += 1
+
+    def add_span(self, name: str, ms: float):
+        with self._lock:
+            if not self._finished:
+                self.spans.append({"name": name, "ms": ms})
+
+    def finish(self, status: Optional[int]):
+        self.status = status
+        self.wall_ms = (time.perf_counter() - self._t0) * 1000
+        self.cpu_ms = (time.process_time() - self._cpu0) * 1000
+        # Freeze a snapshot so exports never iterate a Counter the sampler is still writing
+        with self._lock:
+            self._finished = True
+            self.stacks = Counter(self.stacks)
+            self.spans = list(self.spans)
+
+    def summary(self) -> Dict:
+        breakdown = Counter()
+        for span in self.spans:
+            breakdown[span["name"]] += span["ms"]
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "startedAt": self.started_at,
+            "wallMs": round(self.wall_ms, 2),
+            "processCpuMs": round(self.cpu_ms, 2),
+            "samples": sum(self.stacks.values()),
+            "spans": {name: round(ms, 2) for name, ms in breakdown.items()}
+        }
+
+    def collapsed(self) -> str:
+        """Brendan Gregg collapsed-stack format: `frame;frame;frame count` per line."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def speedscope(self) -> Dict:
+        frames: List[Dict] = []
+        index: Dict[str, int] = {}
+        samples, weights = [], []
+        interval_ms = PROFILE_INTERVAL_SECONDS * 1000
+        for stack, count in self.stacks.items():
+            ids = []
+            for name in stack.split(";"):
+                if name not in index:
+                    index[name] = len(frames)
+                    frames.append({"name": name})
+                ids.append(index[name])
+            samples.append(ids)
+            weights.append(count * interval_ms)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{self.method} {self.path} ({self.id})",
+            "exporter": "artisan-api",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{self.method} {self.path}",
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights
+            }]
+        }
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _is_idle(frame) -> bool:
+    # Threads parked on a lock/selector are waiting, not working
+    return frame.f_code.co_name in {"wait", "select", "_wait_for_tstate_lock", "acquire", "get"} and \
+        os.path.basename(frame.f_code.co_filename) in {"threading.py", "selectors.py", "queue.py", "base_events.py"}
+
+
+class _Sampler:
+    """One background thread that samples stacks for every active profile."""
+
+    def __init__(self):
+        self._active: Dict[str, RequestProfile] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, profile: RequestProfile):
+        with self._lock:
+            self._active[profile.id] = profile
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, profile: RequestProfile):
+        with self._lock:
+            self._active.pop(profile.id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                profiles = list(self._active.values())
+            if not profiles:
+                self._wakeup.clear()
+                self._wakeup.wait(timeout=30)
+                continue
+            frames = sys._current_frames()
+            for profile in profiles:
+                for ident, thread_name in profile.threads().items():
+                    frame = frames.get(ident)
+                    if frame is None or _is_idle(frame):
+                        continue
+                    stack = []
+                    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                        stack.append(_frame_name(frame))
+                        frame = frame.f_back
+                    profile.add_sample(";".join([thread_name, *reversed(stack)]))
+            time.sleep(PROFILE_INTERVAL_SECONDS)
+
+
+_sampler = _Sampler()
+_current: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("request_profile", default=None)
+_ring: deque = deque(maxlen=PROFILE_RING_SIZE)
+_worker_names = itertools.count()
+
+
+@contextmanager
+def profile_span(name: str):
+    """Times a block for the active request profile and samples its thread while inside.
+
+    Context variables follow run_in_threadpool, so spans opened in threadpool code
+    (e.g. transcription) attach to the request that scheduled them. No-op when the
+    request isn't being profiled.
+    """
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    on_loop = threading.get_ident() in profile.threads()
+    if not on_loop:
+        profile.enter_thread(f"worker-{next(_worker_names)}")
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, (time.perf_counter() - start) * 1000)
+        if not on_loop:
+            profile.leave_thread()
+
+
+async def _should_profile(request: Request) -> bool:
+    if request.headers.get(PROFILE_HEADER) == "1":
+        authorization = request.headers.get("authorization", "")
+        if authorization.startswith("Bearer "):
+            try:
+                # Token verification can fetch Google's signing keys; keep it off the event loop
+                decoded = await run_in_threadpool(auth.verify_id_token, authorization.split(" ")[1])
+                return is_admin_token(decoded)
+            except Exception as e:
+                logger.warning(f"Ignoring profile header with invalid token: {e}")
+        return False
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+async def profiling_middleware(request: Request, call_next):
+    if not await _should_profile(request):
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path, threading.get_ident())
+    token = _current.set(profile)
+    _sampler.start(profile)
+    status = None
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Profile-Id"] = profile.id
+        return response
+    finally:
+        _sampler.stop(profile)
+        _current.reset(token)
+        profile.finish(status)
+        _ring.append(profile)
+
+
+def list_profiles() -> List[Dict]:
+    return [p.summary() for p in reversed(_ring)]
+
+
+def get_profile(profile_id: str) -> Optional[RequestProfile]:
+    return next((p for p in _ring if p.id == profile_id), None)
@@ -0,0 +1,39 @@
+from fastapi import HTTPException
+from typing import Dict, Iterable, List, Optional
+
+# Top-level fields of a `products` document that clients may project
+PRODUCT_FIELDS = [
+    "productId", "artisanId", "title", "tagline", "story",
+    "native_title", "native_tagline", "native_story", "category",
+    "imageUrl", "imageVariants", "audioUrl", "lang", "region", "createdAt", "timestamp"
+]
+
+
+def parse_fields(fields: Optional[str], allowed: Iterable[str]) -> Optional[List[str]]:
+    """Parses a `fields=a,b,c` query parameter into a validated list (None = everything)."""
+    if not fields:
+        return None
+    allowed = list(allowed)
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {unknown}. Allowed: {allowed}")
+    return requested or None
+
+
+def with_required(fields: Optional[List[str]], *required: str) -> Optional[List[str]]:
+    """Adds fields the handler itself needs (e.g. ids for joins) to a projection."""
+    if fields is None:
+        return None
+    return list(dict.fromkeys([*fields, *required]))
+
+
+def select(query, fields: Optional[List[str]]):
+    """Applies a Firestore `select()` projection to a query when fields are given."""
+    return query.select(fields) if fields is not None else query
+
+
+def project(data: Dict, fields: Optional[List[str]]) -> Dict:
+    if fields is None:
+        return data
+    return {f: data.get(f) for f in fields}
@@ -0,0 +1,369 @@
+import math
+import os
+import threading
+import time
+import logging
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.requests import HTTPConnection
+
+logger = logging.getLogger(__name__)
+
+# Rough cost model: one unit ~= one minute of audio at typical upload bitrates (~1MB)
+AUDIO_BYTES_PER_COST_UNIT = int(os.getenv("RATE_LIMIT_AUDIO_BYTES_PER_UNIT", str(1024 * 1024)))
+# Number of reverse proxies in front of the app that append to X-Forwarded-For (0 = ignore the header)
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+# After a Redis error, use the in-process backend for this long before trying Redis again
+REDIS_RETRY_SECONDS = 30.0
+# A concurrency slot not released or renewed within this long is presumed leaked (crashed worker)
+SLOT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_SLOT_SECONDS", "900"))
+
+
+@dataclass
+class LimitConfig:
+    capacity: float          # burst size, in cost units
+    refill_per_second: float # sustained rate, in cost units per second
+    max_concurrency: int     # in-flight requests allowed for the whole endpoint class
+
+
+def _env_limit(name: str, capacity: float, refill_per_minute: float, max_concurrency: int) -> LimitConfig:
+    """Reads RATE_LIMIT_<NAME>="capacity,refill_per_minute,max_concurrency" with defaults."""
+    raw = os.getenv(f"RATE_LIMIT_{name.upper()}")
+    if raw:
+        try:
+            capacity, refill_per_minute, max_concurrency = [float(v) for v in raw.split(",")]
+        except ValueError:
+            logger.warning(f"Ignoring malformed RATE_LIMIT_{name.upper()}={raw!r}")
+    return LimitConfig(capacity, refill_per_minute / 60.0, int(max_concurrency))
+
+
+ENDPOINT_LIMITS: Dict[str, LimitConfig] = {
+    "transcription": _env_limit("transcription", capacity=30, refill_per_minute=10, max_concurrency=4),
+    "llm": _env_limit("llm", capacity=20, refill_per_minute=10, max_concurrency=8),
+}
+
+
+def audio_cost(size: Optional[int], passes: int = 1) -> float:
+    """Estimated cost of transcribing an upload, proportional to its size and Whisper passes."""
+    return max(1.0, (size or 0) / AUDIO_BYTES_PER_COST_UNIT) * passes
+
+
+def image_cost(count: int) -> float:
+    return 1.0 + count
+
+
+def client_ip(request: HTTPConnection) -> str:
+    """The caller's address as seen by the outermost trusted proxy.
+
+    X-Forwarded-For is client-controlled except for the entries our own proxies append,
+    so only the last TRUSTED_PROXY_HOPS entries are believed; with no trusted proxies
+    the socket peer is used.
+    """
+    if TRUSTED_PROXY_HOPS > 0:
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+# --- Backends ---
+class InProcessBackend:
+    """Token buckets and concurrency counters held in this worker's memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, last_refill)
+        self._inflight: Dict[str, int] = {}
+
+    def take(self, keys, cost: float, config: LimitConfig) -> float:
+        """Debits `cost` from every bucket in `keys`, or none of them. Returns seconds to wait (0 = admitted)."""
+        now = time.monotonic()
+        with self._lock:
+            levels = {}
+            for key in keys:
+                tokens, last = self._buckets.get(key, (config.capacity, now))
+                levels[key] = min(config.capacity, tokens + (now - last) * config.refill_per_second)
+            shortfall = max(cost - level for level in levels.values())
+            if shortfall > 0:
+                for key, level in levels.items():
+                    self._buckets[key] = (level, now)
+                return shortfall / config.refill_per_second
+            for key, level in levels.items():
+                self._buckets[key] = (level - cost, now)
+            return 0.0
+
+    def enter(self, endpoint_class: str, limit: int) -> Optional[str]:
+        """Takes a slot; returns its token, or None when the class is at its ceiling."""
+        with self._lock:
+            current = self._inflight.get(endpoint_class, 0)
+            if current >= limit:
+                return None
+            self._inflight[endpoint_class] = current + 1
+            return uuid.uuid4().hex
+
+    def renew(self, endpoint_class: str, token: str):
+        # Slots die with the process, so they never need to expire
+        pass
+
+    def leave(self, endpoint_class: str, token: str):
+        with self._lock:
+            self._inflight[endpoint_class] = max(0, self._inflight.get(endpoint_class, 1) - 1)
+
+
+_TAKE_SCRIPT = """
+local cost = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local levels = {}
+local shortfall = 0
+for i, key in ipairs(KEYS) do
+  local state = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(state[1]) or capacity
+  local ts = tonumber(state[2]) or now
+  tokens = math.min(capacity, tokens + (now - ts) * rate)
+  levels[i] = tokens
+  shortfall = math.max(shortfall, cost - tokens)
+end
+local debit = 0
+if shortfall <= 0 then debit = cost end
+local ttl = math.ceil(capacity / rate) + 1
+for i, key in ipairs(KEYS) do
+  redis.call('HSET', key, 'tokens', levels[i] - debit, 'ts', now)
+  redis.call('EXPIRE', key, ttl)
+end
+return tostring(shortfall)
+"""
+
+
+# Slots are ZSET members scored by their expiry (Redis server time), so a slot leaked by a
+# crashed worker or a failed release drops out on its own without touching live ones
+_ENTER_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local limit = tonumber(ARGV[1])
+local lease = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+  return 0
+end
+redis.call('ZADD', KEYS[1], now + lease, ARGV[3])
+if redis.call('TTL', KEYS[1]) < lease then
+  redis.call('EXPIRE', KEYS[1], math.ceil(lease))
+end
+return 1
+"""
+
+_RENEW_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local lease = tonumber(ARGV[1])
+if redis.call('ZADD', KEYS[1], 'XX', 'CH', now + lease, ARGV[2]) == 1 and redis.call('TTL', KEYS[1]) < lease then
+  redis.call('EXPIRE', KEYS[1], math.ceil(lease))
+end
+return 1
+"""
+
+
+class RedisBackend:
+    """Shared state across workers; bucket debits and slot admissions are single Lua scripts."""
+
+    def __init__(self, url: str):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        # from_url/register_script are lazy; fail here rather than on the first request
+        self._client.ping()
+        self._take = self._client.register_script(_TAKE_SCRIPT)
+        self._enter = self._client.register_script(_ENTER_SCRIPT)
+        self._renew = self._client.register_script(_RENEW_SCRIPT)
+
+    def take(self, keys, cost: float, config: LimitConfig) -> float:
+        shortfall = float(self._take(
+            keys=[f"ratelimit:{k}" for k in keys],
+            args=[cost, config.capacity, config.refill_per_second, time.time()]
+        ))
+        return shortfall / config.refill_per_second if shortfall > 0 else 0.0
+
+    def enter(self, endpoint_class: str, limit: int) -> Optional[str]:
+        token = uuid.uuid4().hex
+        admitted = self._enter(keys=[f"ratelimit:slots:{endpoint_class}"], args=[limit, SLOT_LEASE_SECONDS, token])
+        return token if int(admitted) else None
+
+    def renew(self, endpoint_class: str, token: str):
+        self._renew(keys=[f"ratelimit:slots:{endpoint_class}"], args=[SLOT_LEASE_SECONDS, token])
+
+    def leave(self, endpoint_class: str, token: str):
+        self._client.zrem(f"ratelimit:slots:{endpoint_class}", token)
+
+
+class FallbackBackend:
+    """Uses Redis while it answers and the in-process backend while it doesn't.
+
+    A Redis outage degrades limits to per-worker instead of failing every AI endpoint.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.local = InProcessBackend()
+        self._redis: Optional[RedisBackend] = None
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        if time.monotonic() < self._down_until:
+            return self.local
+        if self._redis is None:
+            with self._lock:
+                if self._redis is None and time.monotonic() >= self._down_until:
+                    try:
+                        self._redis = RedisBackend(self.url)
+                        logger.info("Rate limiter using shared Redis backend")
+                    except Exception as e:
+                        self.mark_down(e)
+                        return self.local
+        return self._redis or self.local
+
+    def mark_down(self, error: Exception):
+        logger.warning(f"Redis rate-limit backend unavailable, using in-process limits: {error}")
+        self._down_until = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+def _make_backend():
+    url = os.getenv("RATE_LIMIT_REDIS_URL")
+    return FallbackBackend(url) if url else InProcessBackend()
+
+
+_backend = _make_backend()
+
+
+def _resolve():
+    return _backend.current() if isinstance(_backend, FallbackBackend) else _backend
+
+
+# --- Admission ---
+class Lease:
+    """A held concurrency slot; await release() exactly once (extra calls are no-ops).
+
+    Slots expire after SLOT_LEASE_SECONDS unless renewed; long sessions renew through
+    `charge(..., lease=lease)`.
+    """
+
+    def __init__(self, endpoint_class: str, backend, token: str):
+        self.endpoint_class = endpoint_class
+        self._backend = backend
+        self._token = token
+        self._released = False
+
+    def renew(self):
+        """Pushes the slot's expiry out again (blocking; errors are logged)."""
+        if not self._released:
+            try:
+                self._backend.renew(self.endpoint_class, self._token)
+            except Exception as e:
+                logger.warning(f"Failed to renew {self.endpoint_class} slot: {e}")
+
+    async def release(self):
+        if not self._released:
+            self._released = True
+            try:
+                await run_in_threadpool(self._backend.leave, self.endpoint_class, self._token)
+            except Exception as e:
+                logger.error(f"Failed to release {self.endpoint_class} slot: {e}")
+
+
+def _enter_and_take(backend, endpoint_class: str, keys, cost: float, config: LimitConfig):
+    """Returns (token, wait); the slot is given back if the bucket check fails or raises."""
+    token = backend.enter(endpoint_class, config.max_concurrency)
+    if token is None:
+        return None, 0.0
+    try:
+        wait = backend.take(keys, cost, config)
+    except Exception:
+        backend.leave(endpoint_class, token)
+        raise
+    if wait > 0:
+        backend.leave(endpoint_class, token)
+    return token, wait
+
+
+async def admit(endpoint_class: str, request: HTTPConnection, uid: Optional[str] = None, cost: float = 1.0) -> Lease:
+    """Admits a request to an expensive endpoint class or raises 429/503 with Retry-After.
+
+    A slot is taken from the endpoint class's global concurrency ceiling first, then the
+    caller's IP bucket (and uid bucket, for authenticated callers) is charged `cost`.
+    `uid` must come from a verified token, never from request data. The backend calls
+    run in the threadpool.
+    """
+    return await run_in_threadpool(_admit, endpoint_class, request, uid, cost)
+
+
+def _admit(endpoint_class: str, request: HTTPConnection, uid: Optional[str], cost: float) -> Lease:
+    config = ENDPOINT_LIMITS[endpoint_class]
+    cost = min(cost, config.capacity)  # a single oversized upload must still be admissible
+    keys = [f"{endpoint_class}:ip:{client_ip(request)}"]
+    if uid:
+        keys.append(f"{endpoint_class}:uid:{uid}")
+
+    backend = _resolve()
+    try:
+        token, wait = _enter_and_take(backend, endpoint_class, keys, cost, config)
+    except Exception as e:
+        if not isinstance(_backend, FallbackBackend) or backend is _backend.local:
+            raise
+        _backend.mark_down(e)
+        backend = _backend.local
+        token, wait = _enter_and_take(backend, endpoint_class, keys, cost, config)
+
+    if token is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy. Please retry shortly.",
+            headers={"Retry-After": "5"}
+        )
+    if wait > 0:
+        logger.info(f"Rate limited {keys} on {endpoint_class} (cost={cost:.1f}, retry in {wait:.0f}s)")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please retry later.",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+    return Lease(endpoint_class, backend, token)
+
+
+async def charge(endpoint_class: str, request: HTTPConnection, uid: Optional[str] = None, cost: float = 1.0,
+                 lease: Optional[Lease] = None):
+    """Debits `cost` from the caller's buckets without taking a concurrency slot.
+
+    For work metered while it runs (e.g. streamed audio) under a Lease already held,
+    which is renewed as well. Raises 429 with Retry-After when the buckets are empty.
+    """
+    await run_in_threadpool(_charge, endpoint_class, request, uid, cost, lease)
+
+
+def _charge(endpoint_class: str, request: HTTPConnection, uid: Optional[str], cost: float,
+            lease: Optional[Lease]):
+    if lease is not None:
+        lease.renew()
+    config = ENDPOINT_LIMITS[endpoint_class]
+    cost = min(cost, config.capacity)
+    keys = [f"{endpoint_class}:ip:{client_ip(request)}"]
+    if uid:
+        keys.append(f"{endpoint_class}:uid:{uid}")
+    backend = _resolve()
+    try:
+        wait = backend.take(keys, cost, config)
+    except Exception as e:
+        if not isinstance(_backend, FallbackBackend) or backend is _backend.local:
+            raise
+        _backend.mark_down(e)
+        wait = _backend.local.take(keys, cost, config)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests. Please retry later.",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )